@@ -25,7 +25,7 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import json
-from ansible_collections.heilerich.maas.plugins.module_utils.api import APISession
+from ansible_collections.heilerich.maas.plugins.module_utils.api import get_task_session
 from ansible_collections.heilerich.maas.plugins.module_utils.helpers import AttrDict
 from ansible.utils.display import Display
 from ansible.plugins.action import ActionBase
@@ -84,7 +84,7 @@ class ActionModule(ActionBase):
                 return self.result
 
         try:
-            session = APISession(config.maas_url, config.api_key, config.api_version)
+            session = get_task_session(self._task, task_vars, self.result, config.maas_url, config.api_key, config.api_version)
 
             if config.check_mode:
                 if config.method == 'GET':
@@ -24,7 +24,7 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-from ansible_collections.heilerich.maas.plugins.module_utils.api import APISession, APIError
+from ansible_collections.heilerich.maas.plugins.module_utils.api import get_task_session, APIError
 from ansible_collections.heilerich.maas.plugins.module_utils.helpers import AttrDict, MachinePoller
 from ansible.utils.display import Display
 from ansible.plugins.action import ActionBase
@@ -62,9 +62,14 @@ class ActionModule(ActionBase):
             distro_series = self._task.args.get('distro_series', None),
             hwe_kernel = self._task.args.get('hwe_kernel', None),
             comment = self._task.args.get('comment', None),
-            wait = self._task.args.get('wait', False),
+            wait = self._task.args.get('wait', True),
             wait_interval = int(self._task.args.get('wait_interval', 5)),
             wait_timeout = int(self._task.args.get('wait_timeout', 600)),
+            wait_backoff = float(self._task.args.get('wait_backoff', 1)),
+            wait_max_interval = int(self._task.args.get('wait_max_interval', 60)),
+            wait_jitter = float(self._task.args.get('wait_jitter', 0)),
+            wait_expected = self._task.args.get('wait_expected', None),
+            wait_mode = self._task.args.get('wait_mode', 'poll'),
             install_kvm = self._task.args.get('install_kvm', False),
             maas_url = self._task.args.get('maas_url', 'http://localhost:5240/MAAS/'),
             api_key = self._task.args.get('api_key', None)
@@ -73,7 +78,7 @@ class ActionModule(ActionBase):
         try:
             machine_endpoint = 'machines/%s/' % config.system_id
             try:
-                session = APISession(config.maas_url, config.api_key)
+                session = get_task_session(self._task, task_vars, self.result, config.maas_url, config.api_key)
                 machine_response = session.call('GET', machine_endpoint)
                 machine = machine_response.data
                 self.result['machine'] = machine_response.data
@@ -116,13 +121,19 @@ class ActionModule(ActionBase):
 
             self.result['changed'] = True
             self.result['machine'] = deploy_response.data
+            if not config.wait:
+                return self.result
 
+            if isinstance(config.wait_expected, dict):
+                # the target is the numeric status of deployed
+                config.wait_expected = config.wait_expected.get('deployed')
             poller = MachinePoller(config, session)
 
             error, data = poller.wait(config.system_id, 
                                       target=6,
                                       acceptable_status=(6,9),
                                       numeric_status=True)
+            self.result['wait_stats'] = poller.stats.get(config.system_id)
 
             if error is not None:
                 return self._error(error)
@@ -24,7 +24,7 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-from ansible_collections.heilerich.maas.plugins.module_utils.api import APISession, APIError
+from ansible_collections.heilerich.maas.plugins.module_utils.api import get_task_session, APIError
 from ansible_collections.heilerich.maas.plugins.module_utils.helpers import AttrDict, MachinePoller
 from ansible.utils.display import Display
 from ansible.plugins.action import ActionBase
@@ -62,6 +62,11 @@ class ActionModule(ActionBase):
             target = self._task.args.get('target', ''),
             wait_interval = int(self._task.args.get('wait_interval', 5)),
             wait_timeout = int(self._task.args.get('wait_timeout', 600)),
+            wait_backoff = float(self._task.args.get('wait_backoff', 1)),
+            wait_max_interval = int(self._task.args.get('wait_max_interval', 60)),
+            wait_jitter = float(self._task.args.get('wait_jitter', 0)),
+            wait_expected = self._task.args.get('wait_expected', None),
+            wait_mode = self._task.args.get('wait_mode', 'poll'),
             maas_url = self._task.args.get('maas_url', 'http://localhost:5240/MAAS/'),
             api_version = self._task.args.get('api_version', '2.0'),
             api_key = self._task.args.get('api_key', None)
@@ -70,13 +75,14 @@ class ActionModule(ActionBase):
         try:
             machine_endpoint = 'machines/%s/' % config.system_id
 
-            session = APISession(config.maas_url, config.api_key, config.api_version)
+            session = get_task_session(self._task, task_vars, self.result, config.maas_url, config.api_key, config.api_version)
             poller = MachinePoller(config, session)
 
             error, data = poller.wait(config.system_id, 
                                       target=config.target, 
                                       acceptable_status=config.acceptable_status,
                                       numeric_status=False)
+            self.result['wait_stats'] = poller.stats.get(config.system_id)
 
             if error is not None:
                 return self._error(error)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: maas_timing
+    type: aggregate
+    author:
+      - Felix Heilmeyer <code@fehe.eu>
+    short_description: Reports the time spent waiting on the MAAS API.
+    requirements:
+        - Enabled in configuration, e.g. C(callbacks_enabled = heilerich.maas.maas_timing)
+    description:
+        - "Collects a record of every MAAS API call made by the actions of this collection, in all tasks and forks.
+          At the end of the playbook the latency of the calls is summarized per endpoint and per action, with a
+          histogram of the latencies, and the slowest calls are listed."
+        - "The records are appended to files in the directory named by the C(ANSIBLE_MAAS_TIMING_SPOOL) environment
+          variable, which the plugin sets to a temporary directory for the workers it forks. The inventory is
+          loaded before callback plugins are, so to include the calls of the I(heilerich.maas.maas_machines)
+          inventory plugin set the variable to a directory before running the playbook. The records read are
+          removed from it at the end."
+        - "The latency of a call is measured from sending the request until its body is received, including
+          retries but not the time waited for the I(rate_limit)."
+    options:
+        output:
+            description: Write the report as JSON to this file instead of printing it.
+            type: path
+            ini:
+                - key: output
+                  section: callback_maas_timing
+            env:
+                - name: ANSIBLE_MAAS_TIMING_OUTPUT
+        slowest:
+            description: Number of slowest calls listed.
+            type: int
+            default: 10
+            ini:
+                - key: slowest
+                  section: callback_maas_timing
+            env:
+                - name: ANSIBLE_MAAS_TIMING_SLOWEST
+        buckets:
+            description: Upper bounds in seconds of the buckets of the latency histograms, in ascending order.
+            type: list
+            elements: float
+            default: [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+            ini:
+                - key: buckets
+                  section: callback_maas_timing
+            env:
+                - name: ANSIBLE_MAAS_TIMING_BUCKETS
+'''
+
+import os
+import json
+import shutil
+import tempfile
+from bisect import bisect_left
+from ansible.module_utils._text import to_native
+from ansible.plugins.callback import CallbackBase
+from ansible_collections.heilerich.maas.plugins.module_utils.api import TIMING_SPOOL_ENV
+
+
+def percentile(latencies, fraction):
+    # nearest rank of the sorted latencies
+    return latencies[max(0, int(round(fraction * len(latencies))) - 1)]
+
+
+def summarize(records, buckets):
+    latencies = sorted(record['latency'] for record in records)
+    histogram = [0] * (len(buckets) + 1)
+    for latency in latencies:
+        histogram[bisect_left(buckets, latency)] += 1
+    return dict(
+        calls=len(records),
+        errors=sum(1 for record in records if record['status'] is None or record['status'] >= 400),
+        retries=sum(record['retries'] or 0 for record in records),
+        bytes_in=sum(record['bytes_in'] or 0 for record in records),
+        bytes_out=sum(record['bytes_out'] or 0 for record in records),
+        total=sum(latencies),
+        mean=sum(latencies) / len(latencies),
+        p50=percentile(latencies, 0.5),
+        p95=percentile(latencies, 0.95),
+        max=latencies[-1],
+        histogram=histogram,
+    )
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'heilerich.maas.maas_timing'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        # set before any worker is forked, so all of them inherit it
+        self.spool = os.environ.get(TIMING_SPOOL_ENV)
+        self.own_spool = not self.spool
+        if self.own_spool:
+            self.spool = tempfile.mkdtemp(prefix='maas-timing-')
+            os.environ[TIMING_SPOOL_ENV] = self.spool
+        elif not os.path.isdir(self.spool):
+            os.makedirs(self.spool, 0o700)
+
+    def _read_records(self):
+        records = []
+        for name in sorted(os.listdir(self.spool)):
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.spool, name)
+            with open(path) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # the last line of a worker that was killed while writing it
+                        continue
+            if not self.own_spool:
+                os.unlink(path)
+        if self.own_spool:
+            shutil.rmtree(self.spool, ignore_errors=True)
+        return records
+
+    def _report(self, records):
+        buckets = sorted(float(bucket) for bucket in self.get_option('buckets'))
+        by_endpoint, by_action = {}, {}
+        for record in records:
+            by_endpoint.setdefault('%s %s' % (record['method'], record['endpoint']), []).append(record)
+            by_action.setdefault(record.get('action') or 'unknown', []).append(record)
+        slowest = sorted(records, key=lambda record: -record['latency'])[:self.get_option('slowest')]
+        return dict(
+            buckets=buckets,
+            total=summarize(records, buckets) if records else None,
+            endpoints=dict((key, summarize(group, buckets)) for key, group in by_endpoint.items()),
+            actions=dict((key, summarize(group, buckets)) for key, group in by_action.items()),
+            slowest=slowest,
+        )
+
+    def _print_summaries(self, title, summaries, buckets):
+        self._display.display('%s:' % title)
+        labels = ['<=%gs' % bucket for bucket in buckets] + ['>%gs' % buckets[-1]] if buckets else ['all']
+        for key, summary in sorted(summaries.items(), key=lambda item: -item[1]['total']):
+            self._display.display('  %s: %d calls, %.2fs total, mean %.3fs, p50 %.3fs, p95 %.3fs, max %.3fs, '
+                                  '%d retries, %d errors, %d bytes in, %d bytes out'
+                                  % (key, summary['calls'], summary['total'], summary['mean'], summary['p50'],
+                                     summary['p95'], summary['max'], summary['retries'], summary['errors'],
+                                     summary['bytes_in'], summary['bytes_out']))
+            self._display.display('    %s' % ' '.join('%s:%d' % (label, count) for label, count
+                                                        in zip(labels, summary['histogram']) if count))
+
+    def v2_playbook_on_stats(self, stats):
+        try:
+            records = self._read_records()
+        except (IOError, OSError) as e:
+            self._display.warning('Unable to read the MAAS API timing records: %s' % to_native(e))
+            return
+        report = self._report(records)
+
+        output = self.get_option('output')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self._display.display('MAAS API timing written to %s' % output)
+            return
+
+        self._display.banner('MAAS API TIMING')
+        if not records:
+            self._display.display('No MAAS API calls were made')
+            return
+        total = report['total']
+        self._display.display('%d calls, %.2fs total, %d retries, %d errors'
+                              % (total['calls'], total['total'], total['retries'], total['errors']))
+        self._print_summaries('Endpoints', report['endpoints'], report['buckets'])
+        self._print_summaries('Actions', report['actions'], report['buckets'])
+        self._display.display('Slowest calls:')
+        for record in report['slowest']:
+            self._display.display('  %.3fs %s %s (%s)%s' % (record['latency'], record['method'], record['endpoint'],
+                                                           record['status'] or record.get('error'),
+                                                           ' %s on %s' % (record.get('task') or record.get('action'),
+                                                                          record['host']) if record.get('host') else ''))
@@ -30,6 +30,7 @@ class ModuleDocFragment(object):
 requirements:
     - python >= 2.7
     - L(requests-oauthlib,https://pypi.org/project/requests-oauthlib/) >= 1.3.0
+    - L(orjson,https://pypi.org/project/orjson/) (optional, decodes large responses faster)
 options:
     maas_url:
         description: URL pointing to the API of the controller
@@ -40,4 +41,91 @@ options:
         description: API key obtained from (/MAAS/account/prefs/). Alternatively specify username and password.
         type: str
         required: false
+    pool_size:
+        description: "Maximum number of keep-alive connections to the MAAS API. Connections are shared by everything
+            in a process that uses the same I(maas_url), I(api_key) and API version."
+        type: int
+        default: 10
+    cache_ttl:
+        description:
+            - "Cache successful GET responses for this many seconds. Either a number for all endpoints or a dict of
+              endpoint prefixes and seconds, e.g. C({'users/': 3600, 'pods/': 60, 'machines/': 5}), in which the
+              longest matching prefix applies. Responses of other endpoints are not cached."
+            - "The cache is shared by all processes of the user, e.g. the forks of a play. Any other request than
+              GET removes the cached responses of the same and of enclosing or enclosed paths."
+            - Disabled by default.
+        type: raw
+    cache_size:
+        description: Maximum number of responses kept by the I(cache_ttl) response cache.
+        type: int
+        default: 256
+    retries:
+        description: How often a request is retried after a connection error or a response with I(retry_status).
+        type: int
+        default: 5
+    retry_backoff:
+        description: "Backoff factor of the retries, the n-th retry waits I(retry_backoff) * 2^(n-1) seconds (the
+            first retry is immediate). A C(Retry-After) header of the response is honored instead, up to 120 seconds."
+        type: float
+        default: 2
+    retry_jitter:
+        description: "Random delay of up to this many seconds added to every retry with a backoff (all but the
+            first), so concurrent tasks spread out."
+        type: float
+        default: 1
+    retry_status:
+        description:
+            - "HTTP status codes of responses that are retried, e.g. C([502, 503, 504]). By default only connection
+              errors are retried, so a failing region fails fast."
+            - "Responses with the status 413, 429 or 503 and a C(Retry-After) header are retried after the requested
+              delay even if their status is not listed."
+        type: list
+        elements: int
+        default: []
+    retry_idempotent_only:
+        description: "Only retry responses with I(retry_status) for idempotent methods (GET, PUT, DELETE, ...), not
+            for POST operations like deploying a machine. Failed connection attempts are retried for all methods."
+        type: bool
+        default: yes
+    circuit_breaker:
+        description: "Number of server errors (5xx status or connection errors, after the retries) in a row after
+            which requests to the region fail immediately for I(circuit_breaker_timeout) seconds. The count is
+            shared by all processes of the user. Set to I(0) to disable the circuit breaker."
+        type: int
+        default: 0
+    circuit_breaker_timeout:
+        description: Seconds the circuit breaker stays open before requests to the region are attempted again.
+        type: int
+        default: 30
+    rate_limit:
+        description: "Maximum number of requests per second to the region, shared by all processes of the user,
+            e.g. all forks of a play. Requests over the limit wait for their turn. Set to I(0) for no limit."
+        type: float
+        default: 0
+    rate_burst:
+        description: Number of requests that may exceed I(rate_limit) in a burst, defaults to I(rate_limit).
+        type: int
+        default: 0
+    max_in_flight:
+        description: "Maximum number of concurrent requests to the region, shared by all processes of the user.
+            Requests over the limit wait for a running one to finish. Set to I(0) for no limit."
+        type: int
+        default: 0
+    conditional_get:
+        description:
+            - "Keep the validators (C(ETag), C(Last-Modified)) and the decoded body of the last successful GET
+              response of each URL and send conditional requests. If the body is not modified, or has the same hash
+              when the server doesn't support validators, the decoded body is reused instead of transferred and
+              decoded again."
+            - "The responses are kept by the API session of the process, up to I(conditional_get_size) bytes of them.
+              This saves the most for repeated requests to the same URL, e.g. the polls of a wait or
+              C(meta: refresh_inventory). Streamed listings and the listings the inventory plugin projects to its
+              I(fields) are not kept."
+        type: bool
+        default: no
+    conditional_get_size:
+        description: "Maximum number of bytes of the response bodies kept for I(conditional_get). The least recently
+            used responses are dropped first, larger responses are not kept."
+        type: int
+        default: 16777216
 '''
@@ -29,7 +29,8 @@ class ModuleDocFragment(object):
     DOCUMENTATION = r'''
 options:
     wait_interval:
-        description: How often to poll, defaults to 5 seconds.
+        description: "How often to poll, defaults to 5 seconds. With I(wait_backoff) this is the shortest interval.
+            Intervals are measured from the start of the previous poll, so slow requests don't delay the next one."
         type: int
         default: 5
     wait_timeout:
@@ -37,4 +38,36 @@ options:
             to 600 seconds."
         type: int
         default: 600
+    wait_backoff:
+        description: "Factor by which the interval grows after each poll that saw no status change, up to
+            I(wait_max_interval). A status change resets it to I(wait_interval). I(1) polls at a fixed interval."
+        type: float
+        default: 1
+    wait_max_interval:
+        description: "Longest interval between polls with I(wait_backoff), and between requests of the machines
+            with I(wait_mode=events)."
+        type: int
+        default: 60
+    wait_mode:
+        description:
+            - "With I(poll) the machines are requested every interval. With I(events) the MAAS event log of the
+              machines is queried instead, which is much cheaper for the region, and the machines are only
+              requested to confirm their status after they had new events, or after I(wait_max_interval)
+              seconds without."
+        type: str
+        choices: [poll, events]
+        default: poll
+    wait_jitter:
+        description: "Fraction by which each interval varies randomly, e.g. I(0.1) for +/-10%, so waits that
+            started together spread out."
+        type: float
+        default: 0
+    wait_expected:
+        description:
+            - "Seconds after which the desired state is expected to be reached, either a number or a dict of
+              target status names and seconds, e.g. C({'deployed': 600, 'ready': 900})."
+            - "Polls don't skip past this time, and the interval is reset to I(wait_interval) when it is reached, so
+              the end of a predictable wait is noticed quickly while polling less often before it."
+        type: raw
+        required: false
 '''
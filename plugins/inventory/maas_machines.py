@@ -36,6 +36,8 @@ DOCUMENTATION = '''
     description:
         - Reads inventories from the MAAS API
         - Uses a YAML configuration file [*]maas.[yml|yaml].
+        - The constructed features (I(compose), I(groups), I(keyed_groups)) are only passed the host variables their
+          expressions reference.
     options:
         plugin:
             description: The name of this plugin, it should always be set to C(heilerich.maas.maas_machines)
@@ -55,6 +57,157 @@ DOCUMENTATION = '''
             type: str
             choices: [ ip, hostname, fqdn ]
             default: ip
+        machine_vars:
+            description:
+                - "Controls how the MAAS machine data is made available as the I(maas_machine) host variable.
+                  With I(none) only I(maas_id), I(ansible_host) and the variables of the constructed features are set."
+                - "I(inline) sets I(maas_machine) on every host when the inventory is parsed."
+                - "I(lazy) writes the machine data to an indexed file in I(details_store) and only sets the path of
+                  that file as I(maas_details_store). The I(heilerich.maas.maas_details) vars plugin reads the data
+                  of a host once it is used by a play. The vars plugin must be enabled, e.g. with
+                  C(vars_plugins_enabled = host_group_vars,heilerich.maas.maas_details) in ansible.cfg."
+            type: str
+            choices: [ none, inline, lazy ]
+            default: none
+        details_store:
+            description: Directory of the machine data files written with I(machine_vars=lazy).
+            type: path
+            default: ~/.ansible/tmp/maas_details
+            env:
+                - name: ANSIBLE_MAAS_DETAILS_STORE
+        streaming:
+            description: "If set to I(yes) the machine listings are decoded one machine at a time while they are
+                downloaded. Combined with I(fields) this keeps the memory usage close to the size of the
+                kept data for very large MAAS installations."
+            type: bool
+            default: no
+        regions:
+            description:
+                - "A list of independent MAAS regions to read the inventory from. The regions are fetched concurrently
+                  and merged into one inventory. If set, I(maas_url) and I(api_key) are ignored."
+                - "Each entry is a dict with the keys I(maas_url), I(api_key), an optional I(group_prefix), an
+                  optional I(timeout) in seconds for each request to that region and an optional I(deadline) in
+                  seconds for fetching the whole region."
+                - "The I(deadline) of a region with a I(timeout) defaults to the time all attempts of one request may
+                  take, I(timeout) times one more than I(retries). A region without either has no deadline."
+                - "The default groups (metal, zones, pools, ...) of hosts from a region with a I(group_prefix) are
+                  prefixed with it, and those hosts are added to a group named like the prefix."
+                - "If a region fails or misses its deadline, or a host name appears in more than one region, the
+                  region or host is skipped with a warning unless I(strict) is set. The requests of a region that
+                  missed its deadline are left running in the background and their results are discarded."
+            type: list
+            elements: dict
+            default: []
+        fetch_workers:
+            description: "Maximum number of API endpoints (machines, region and rack controllers) that are fetched
+                concurrently. Set to I(1) to fetch them one after another."
+            type: int
+            default: 3
+        enrich:
+            description:
+                - "Additional per-machine API endpoints whose data is added to the MAAS machine data, e.g. the power
+                  parameters or the interface and block device listings that are not part of the machines listing."
+                - "Each entry is a dict with a I(name), the key the data is added under, an I(endpoint) in which
+                  C({system_id}) is replaced by the system id of the machine and an optional I(query) dict."
+                - "The data is added after I(fields) and I(exclude_fields) are applied and cached with the hosts.
+                  Failed requests are skipped with a warning unless I(strict) is set."
+                - "Controllers and, with I(include_vms=no), virtual machines are not enriched."
+            type: list
+            elements: dict
+            default: []
+        enrich_workers:
+            description: Maximum number of concurrent I(enrich) requests to each region.
+            type: int
+            default: 8
+        zone:
+            description: Only return machines in one of the given zones.
+            type: list
+            elements: str
+            default: []
+        pool:
+            description: Only return machines in one of the given resource pools.
+            type: list
+            elements: str
+            default: []
+        tags:
+            description: Only return machines that have all of the given tags.
+            type: list
+            elements: str
+            default: []
+        status:
+            description: "Only return machines with one of the given status, e.g. I(deployed) or I(ready). Use the
+                lowercase status names with underscores (e.g. I(failed_commissioning))."
+            type: list
+            elements: str
+            default: []
+        domain:
+            description: Only return machines in one of the given domains.
+            type: list
+            elements: str
+            default: []
+        owner:
+            description: Only return machines owned by one of the given users.
+            type: list
+            elements: str
+            default: []
+        pod:
+            description: Only return machines that are VMs of one of the given pods (VM hosts).
+            type: list
+            elements: str
+            default: []
+        fields:
+            description:
+                - "Only keep the listed keys of the MAAS machine data. Nested keys can be selected with dotted
+                  paths, e.g. I(boot_interface.mac_address). Lists are traversed, so I(interface_set.name)
+                  keeps the name of every interface."
+                - The projection is applied before the data is cached and before the constructed features are evaluated.
+                - If empty all keys are kept.
+            type: list
+            elements: str
+            default: []
+        cache_soft_timeout:
+            description:
+                - "Age in seconds after which cached hosts are considered stale. Stale hosts are still returned
+                  immediately, but a detached background process refreshes the cache for the next run. Once the
+                  cached hosts are older than I(cache_timeout) they are fetched again before they are returned."
+                - Requires a persistent cache plugin, e.g. I(jsonfile). Set to I(0) to disable background refreshes.
+            type: int
+            default: 0
+        cache_delta_refresh:
+            description:
+                - "When the cache is refreshed, only fetch the machines that changed since the cache was written
+                  instead of the whole fleet. The changed machines are determined from the MAAS event log."
+                - "Applies to cache entries older than I(cache_timeout) and to the background refreshes of
+                  I(cache_soft_timeout). Refreshes with more than 1000 events fall back to a full fetch. Changes
+                  that MAAS does not record as events are only picked up by a full fetch."
+                - "A region is fetched in full again after I(cache_delta_refresh_limit) delta refreshes in a row.
+                  Changing the filters, I(fields), I(exclude_fields), I(enrich), I(include_vms) or
+                  I(include_controllers), flushing the cache (C(--flush-cache)) and C(meta: refresh_inventory) also
+                  fetch all machines."
+            type: bool
+            default: no
+        cache_delta_refresh_limit:
+            description: "Number of delta refreshes (I(cache_delta_refresh)) in a row after which a region is fetched
+                in full again."
+            type: int
+            default: 10
+        cache_lock_timeout:
+            description:
+                - "Seconds to wait for another process that is refreshing the same cache entry. Only one process
+                  fetches the hosts from MAAS, the others wait for it and read the refreshed cache. When the wait
+                  times out, the hosts are fetched without the lock."
+                - "The lock file is created next to the cache for file based cache plugins (e.g. C(jsonfile)) and
+                  in C(~/.ansible/tmp/maas_inventory_locks) for the others. Locks of crashed processes are released
+                  by the operating system. Set to I(0) to disable locking."
+            type: int
+            default: 120
+        exclude_fields:
+            description:
+                - Remove the listed keys from the MAAS machine data. Dotted paths are supported like in I(fields).
+                - Applied after I(fields).
+            type: list
+            elements: str
+            default: []
 '''
 
 EXAMPLES = '''
@@ -83,23 +236,182 @@ groups:
 compose:
     block_devices: physicalblockdevice_set | map(attribute='name')
 
+# Merge the machines of multiple MAAS regions into one inventory
+plugin: heilerich.maas.maas_machines
+maas_url: http://controller:5240/MAAS/
+regions:
+  - maas_url: http://region-eu:5240/MAAS/
+    api_key: xxx
+    group_prefix: eu
+  - maas_url: http://region-us:5240/MAAS/
+    api_key: yyy
+    group_prefix: us
+    timeout: 30
+
+# Let MAAS filter the machines, only deployed machines in zone a or b are returned.
+# The filters are passed to the MAAS API and do not apply to controllers.
+plugin: heilerich.maas.maas_machines
+maas_url: http://controller:5240/MAAS/
+api_key: xxx
+zone: [a, b]
+status: [deployed]
+
+# Only keep the data that is actually used, this keeps the cache small
+plugin: heilerich.maas.maas_machines
+maas_url: http://controller:5240/MAAS/
+api_key: xxx
+fields:
+  - architecture
+  - status_name
+  - boot_interface.mac_address
+  - physicalblockdevice_set.name
+
+# Add the power parameters and the interfaces of every machine to its data
+plugin: heilerich.maas.maas_machines
+maas_url: http://controller:5240/MAAS/
+api_key: xxx
+enrich:
+  - name: power_parameters
+    endpoint: machines/{system_id}/
+    query:
+      op: power_parameters
+  - name: interfaces
+    endpoint: nodes/{system_id}/interfaces/
+
+# Keep the inventory small and load the machine data of a host only when a play uses it,
+# requires the heilerich.maas.maas_details vars plugin to be enabled
+plugin: heilerich.maas.maas_machines
+maas_url: http://controller:5240/MAAS/
+api_key: xxx
+machine_vars: lazy
 '''
 
+import os
 import re
+import json
+import errno
+import hashlib
+import fcntl
+from contextlib import contextmanager
+from sys import intern
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from threading import Lock, Thread
+from time import time, sleep
+from jinja2 import Environment, nodes
 from ansible.errors import AnsibleError
-from ansible.module_utils._text import to_native
+from ansible.module_utils._text import to_bytes, to_native
+from ansible.module_utils.six import string_types
+from ansible.plugins.cache import BaseFileCacheModule
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
 from ansible.utils.display import Display
-from ansible_collections.heilerich.maas.plugins.module_utils.api import APISession
+from ansible_collections.heilerich.maas.plugins.module_utils.api import get_session, SESSION_OPTIONS
 from ansible_collections.heilerich.maas.plugins.module_utils.helpers import AttrDict
+from ansible_collections.heilerich.maas.plugins.module_utils.inventory_cache import encode_hosts, decode_hosts, CacheFormatError
+from ansible_collections.heilerich.maas.plugins.module_utils.details_store import write_store, store_generation
 
 
 display = Display()
 
+MACHINE_FILTERS = ('zone', 'pool', 'tags', 'status', 'domain', 'owner', 'pod')
+
+# more events than this since the last refresh trigger a full fetch (the MAAS API maximum)
+DELTA_EVENT_LIMIT = 1000
+# number of system ids requested in one machines/ call during a delta refresh
+DELTA_BATCH_SIZE = 100
+# seconds between attempts to take the cache lock held by another process
+CACHE_LOCK_INTERVAL = 0.2
+# lock files of cache plugins that don't keep the cache in a local directory, e.g. redis
+CACHE_LOCK_DIR = '~/.ansible/tmp/maas_inventory_locks'
+
+_GROUP_NAMES = {}
+
+
+class FieldProjection(object):
+    ''' Reduces MAAS machine data to the configured (dotted) key paths. '''
+
+    def __init__(self, fields=None, exclude_fields=None, measure=False):
+        self.include = self._tree(fields or [])
+        self.exclude = self._tree(exclude_fields or [])
+        self.measure = measure
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def _tree(paths):
+        # None marks a leaf, i.e. the whole value below that key is selected
+        tree = {}
+        for path in paths:
+            node = tree
+            keys = to_native(path).split('.')
+            for key in keys[:-1]:
+                if key in node and node[key] is None:
+                    break
+                node = node.setdefault(key, {})
+            else:
+                node[keys[-1]] = None
+        return tree
+
+    def _include(self, value, tree):
+        if tree is None:
+            return value
+        if isinstance(value, dict):
+            return dict((k, self._include(value[k], sub)) for k, sub in tree.items() if k in value)
+        if isinstance(value, list):
+            return [self._include(v, tree) for v in value]
+        return value
+
+    def _exclude(self, value, tree):
+        if isinstance(value, dict):
+            return dict((k, v if k not in tree else self._exclude(v, tree[k]))
+                        for k, v in value.items() if k not in tree or tree[k] is not None)
+        if isinstance(value, list):
+            return [self._exclude(v, tree) for v in value]
+        return value
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+    __nonzero__ = __bool__
+
+    def apply(self, data):
+        if not self:
+            return data
+        projected = data
+        if self.include:
+            projected = self._include(projected, self.include)
+        if self.exclude:
+            projected = self._exclude(projected, self.exclude)
+        if self.measure:
+            bytes_in, bytes_out = len(json.dumps(data)), len(json.dumps(projected))
+            with self._lock:
+                self.bytes_in += bytes_in
+                self.bytes_out += bytes_out
+        return projected
+
+    def report(self):
+        if self and self.measure:
+            display.vvv(u'Field projection kept %d of %d bytes of machine data (%d bytes saved)' %
+                        (self.bytes_out, self.bytes_in, self.bytes_in - self.bytes_out))
+
+
+def group_name(group):
+    ''' Sanitized and interned inventory group name, computed once per distinct group. '''
+    try:
+        return _GROUP_NAMES[group]
+    except KeyError:
+        name = _GROUP_NAMES[group] = intern(re.sub(r'[\.\s-]', '_', group))
+        return name
+
 
 class Host(object):
+    __slots__ = ('name', 'hostname', 'maas_id', 'zone', 'domain', 'tags', 'maas_data',
+                 'pool', 'status', 'metal', 'host', 'additional_groups', 'group_prefix', 'region', '_groups')
+    FIELDS = __slots__[:-1]
+    # fields with few distinct values, stored only once in the cache
+    SHARED_FIELDS = ('zone', 'domain', 'pool', 'status', 'metal', 'additional_groups', 'group_prefix', 'region')
+
     @classmethod
-    def from_machine(cls, maas_machine, additional_groups=[]):
+    def from_machine(cls, maas_machine, additional_groups=[], projection=None, region=None):
         data = dict(
             name = to_native(maas_machine['fqdn']),
             hostname = to_native(maas_machine['hostname']),
@@ -107,7 +419,7 @@ class Host(object):
             zone = 'zone_%s' % to_native(maas_machine['zone']['name']),
             domain = 'domain_%s' % to_native(maas_machine['domain']['name']),
             tags = [to_native(t) for t in maas_machine['tag_names']],
-            maas_data = maas_machine
+            maas_data = projection.apply(maas_machine) if projection else maas_machine
         )
         data['pool'] = 'pool_%s' % to_native(maas_machine['pool']['name'] if 'pool' in maas_machine else '') 
         data['status'] = to_native(maas_machine['status_name'].lower() if 'status_name' in maas_machine else '')
@@ -115,27 +427,41 @@ class Host(object):
         data['metal'] = 'controllers' not in additional_groups and maas_machine['pod'] is None
         data['host'] = to_native(maas_machine['ip_addresses'][0] if len(maas_machine['ip_addresses'])>0 else data['name'])
         data['additional_groups'] = additional_groups
+        data['group_prefix'] = region.group_prefix if region else ''
+        data['region'] = region.maas_url if region else ''
         
         return cls(data)
     
     def __init__(self, data):
-        self._data = data
+        for field in self.FIELDS:
+            setattr(self, field, data[field])
+        # group names repeat across thousands of hosts, share a single string instance
+        self.zone, self.domain, self.pool, self.status = (intern(g) for g in (self.zone, self.domain, self.pool, self.status))
+        self.additional_groups = [intern(g) for g in self.additional_groups]
+        groups = [g for g in ['metal' if self.metal else 'virtual', self.zone, self.domain, self.pool, self.status] + self.additional_groups if g != '']
+        if self.group_prefix:
+            groups = [self.group_prefix] + [intern('%s_%s' % (self.group_prefix, g)) for g in groups]
+        self._groups = tuple(groups)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
 
-    def __getattr__(self, name):
-        return self._data[name]
-    
     def groups(self):
-        return [g for g in (['metal' if self.metal else 'virtual', self.zone, self.domain, self.pool, self.status] + self.additional_groups) if g != '']
+        return self._groups
     
     def attrs(self):
         return self.maas_data
     
-    def add_to_inventory(self, inventory, host='ip'):
+    def add_to_inventory(self, inventory, host='ip', known_groups=None):
+        # known_groups is a set of group names that already have been added to the inventory
         inventory.add_host(self.name)
         
-        for group in self.groups():
-            groupname = re.sub('[\.\s-]', '_', group)
-            inventory.add_group(groupname)
+        for group in self._groups:
+            groupname = group_name(group)
+            if known_groups is None or groupname not in known_groups:
+                inventory.add_group(groupname)
+                if known_groups is not None:
+                    known_groups.add(groupname)
             inventory.add_host(self.name, groupname)
         
         inventory.set_variable(self.name, 'maas_id', self.maas_id)
@@ -158,72 +484,563 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     def _error(self, msg):
         raise AnsibleError(msg)
 
-    def _fetch(self):
-        display.vvv(u'Fetching data from MAAS API')
-        try:
-            session = APISession(self._config.maas_url, self._config.api_key)
-            machines = session.call('GET', 'machines/')
+    def _session(self, region):
+        session = get_session(region.maas_url, region.api_key, **dict(self._config.session_options, timeout=region.timeout))
+        session.context = dict(action=self.NAME)
+        return session
+
+    def _get(self, session, endpoint, query=None, conditional=True):
+        response = session.call('GET', endpoint, query=query, stream=self._config.streaming, conditional=conditional)
+        if not response.ok:
+            raise AnsibleError('GET %s returned status %s: %s' % (endpoint, response.status_code, to_native(response.data)))
+        return response.data
+
+    def _fetch_hosts(self, region, session, endpoint, groups, query=None):
+        start_time = time()
+        # conditional_get would keep the whole listing next to the projected hosts
+        hosts = [Host.from_machine(m, groups, self._config.projection, region)
+                 for m in self._get(session, endpoint, query, conditional=not self._config.projection)]
+        display.vvv(u'Fetched %d hosts from %s%s in %.2fs' % (len(hosts), region.maas_url, endpoint, time() - start_time))
+        return hosts
+
+    def _events(self, session, query):
+        response = session.call('GET', 'events/', query=dict(query, op='query', level='DEBUG'))
+        if not response.ok:
+            raise AnsibleError('GET events/ returned status %s: %s' % (response.status_code, to_native(response.data)))
+        return response.data['events']
+
+    def _fetch_region_delta(self, region, cursor, cached_hosts):
+        session = self._session(region)
+        events = self._events(session, dict(after=cursor, limit=DELTA_EVENT_LIMIT))
+        if len(events) >= DELTA_EVENT_LIMIT:
+            raise AnsibleError('more than %d events since the last refresh' % DELTA_EVENT_LIMIT)
+        changed = set(to_native(e['node']) for e in events if e.get('node'))
+        display.vvv(u'Delta refresh of %s: %d events, %d changed machines' % (region.maas_url, len(events), len(changed)))
 
-            region_controllers, rack_controllers = ([], [])
+        refreshed = {}
+        changed_ids = sorted(changed)
+        for i in range(0, len(changed_ids), DELTA_BATCH_SIZE):
+            query = dict(self._config.filters, id=changed_ids[i:i + DELTA_BATCH_SIZE])
+            for host in self._fetch_hosts(region, session, 'machines/', ['machines'], query):
+                refreshed[host.maas_id] = host
+
+        # changed machines that are not returned anymore were deleted or do not match the filters
+        hosts = []
+        for host in cached_hosts:
+            if 'controllers' in host.additional_groups:
+                continue
+            if host.maas_id not in changed:
+                hosts.append(host)
+            elif host.maas_id in refreshed:
+                hosts.append(refreshed.pop(host.maas_id))
+        hosts.extend(refreshed.values())
+
+        if self._config.include_controllers:
+            hosts.extend(self._fetch_hosts(region, session, 'regioncontrollers/', ['controllers', 'region_controllers']))
+            hosts.extend(self._fetch_hosts(region, session, 'rackcontrollers/', ['controllers', 'rack_controllers']))
+
+        # unchanged hosts keep the enrichment data of the cache
+        self._enrich(region, session, [host for host in hosts if host.maas_id in changed])
+
+        self._cursors[region.maas_url] = max([cursor] + [e['id'] for e in events])
+        return hosts
+
+    def _enrich(self, region, session, hosts):
+        # adds the data of the enrich endpoints to the machine data of hosts, except for the controllers and the
+        # VMs that are not added to the inventory
+        enrichments = self._config.enrich
+        hosts = [host for host in hosts if 'controllers' not in host.additional_groups and
+                 (self._config.include_vms or host.metal)]
+        calls = [(host, enrichment) for host in hosts for enrichment in enrichments]
+        if not calls:
+            return
+
+        def fetch(request):
+            host, enrichment = request
+            start_time = time()
+            try:
+                response = session.call('GET', enrichment.endpoint.format(system_id=host.maas_id),
+                                        query=enrichment.query)
+                if not response.ok:
+                    raise AnsibleError('status %s: %s' % (response.status_code, to_native(response.data)))
+                return response.data, None, time() - start_time
+            except Exception as e:
+                return None, e, time() - start_time
+
+        latencies = dict((enrichment.name, []) for enrichment in enrichments)
+        errors = dict((enrichment.name, []) for enrichment in enrichments)
+        workers = max(1, min(self._config.enrich_workers, len(calls)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # results are consumed here, so the machine data is only modified by this thread
+            for (host, enrichment), (data, error, latency) in zip(calls, executor.map(fetch, calls)):
+                latencies[enrichment.name].append(latency)
+                if error is None:
+                    # the machine data may be shared with a response reused by conditional_get
+                    host.maas_data = dict(host.maas_data, **{enrichment.name: data})
+                else:
+                    errors[enrichment.name].append((host, error))
+
+        strict = self.get_option('strict')
+        for enrichment in enrichments:
+            timings, failed = latencies[enrichment.name], errors[enrichment.name]
+            display.vvv(u'Enrichment %s of %s: %d requests, %d errors, %.1fms mean, %.1fms max latency'
+                        % (enrichment.name, region.maas_url, len(timings), len(failed),
+                           sum(timings) / len(timings) * 1000, max(timings) * 1000))
+            if failed:
+                host, error = failed[0]
+                msg = (u'%d of %d %s requests to %s failed, e.g. for %s: %s'
+                       % (len(failed), len(timings), enrichment.name, region.maas_url, host.name, to_native(error)))
+                if strict:
+                    raise AnsibleError(msg)
+                display.warning(msg)
+
+    def _fetch_region(self, region):
+        display.vvv(u'Fetching data from MAAS API at %s' % region.maas_url)
+        try:
+            session = self._session(region)
+            if self._config.delta_refresh:
+                # remember the newest event before fetching, changes after it are picked up by the next delta refresh
+                self._cursors[region.maas_url] = max([e['id'] for e in self._events(session, dict(limit=1))] or [0])
+            display.vvv(u'Machine filters: %s' % self._config.filters)
+            sources = [('machines/', ['machines'], self._config.filters)]
             if self._config.include_controllers:
-                region_controllers = [Host.from_machine(m, ['controllers', 'region_controllers']) 
-                                    for m in session.call('GET', 'regioncontrollers/').data]
-                rack_controllers = [Host.from_machine(m, ['controllers', 'rack_controllers']) 
-                                    for m in session.call('GET', 'rackcontrollers/').data]
-                
-            return [Host.from_machine(m, ['machines']) for m in machines.data] + region_controllers + rack_controllers
+                sources.append(('regioncontrollers/', ['controllers', 'region_controllers']))
+                sources.append(('rackcontrollers/', ['controllers', 'rack_controllers']))
+
+            # results are merged in the order of sources, regardless of which request finishes first
+            hosts = []
+            workers = max(1, min(self._config.fetch_workers, len(sources)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._fetch_hosts, region, session, *source) for source in sources]
+                for future in futures:
+                    hosts.extend(future.result())
+            self._enrich(region, session, hosts)
+            return hosts
         except Exception as e:
-            raise AnsibleError('Unable to fetch data from the MAAS API, this was the original exception: %s' %
-                               to_native(e))
+            raise AnsibleError('Unable to fetch data from the MAAS API at %s, this was the original exception: %s' %
+                               (region.maas_url, to_native(e)))
+
+    def _fetch(self, previous=None):
+        # previous maps region URLs to the event cursor, the cached hosts and the number of delta refreshes since
+        # the last full fetch a delta refresh can start from
+        regions = self._config.regions
+        self._cursors = {}
+        self._delta_refreshes = {}
+        self._merged = set(region.maas_url for region in regions)
 
-    def _populate(self, hosts):
+        def fetch_region(region):
+            if previous and region.maas_url in previous:
+                cursor, cached_hosts, refreshes = previous[region.maas_url]
+                try:
+                    hosts = self._fetch_region_delta(region, cursor, cached_hosts)
+                    self._delta_refreshes[region.maas_url] = refreshes + 1
+                    return hosts
+                except Exception as e:
+                    display.vvv(u'Delta refresh of %s failed, fetching all machines: %s' % (region.maas_url, to_native(e)))
+            hosts = self._fetch_region(region)
+            self._delta_refreshes[region.maas_url] = 0
+            return hosts
+
+        if len(regions) == 1:
+            hosts = fetch_region(regions[0])
+            self._config.projection.report()
+            return hosts
+
+        strict = self.get_option('strict')
+        start_time = time()
+        futures = [self._run_detached(fetch_region, region) for region in regions]
+
+        # regions are merged in the configured order, the first region wins on host name collisions
+        hosts, origins, merged = [], {}, set()
+        for region, future in zip(regions, futures):
+            deadline = self._region_deadline(region)
+            try:
+                region_hosts = future.result(None if deadline is None else max(0, start_time + deadline - time()))
+            except TimeoutError:
+                msg = u'MAAS region %s did not respond within its deadline of %ss' % (region.maas_url, deadline)
+                if strict:
+                    raise AnsibleError(msg)
+                display.warning(u'%s, skipping it' % msg)
+                continue
+            except AnsibleError as e:
+                if strict:
+                    raise
+                display.warning(u'Skipping MAAS region: %s' % to_native(e))
+                continue
+
+            merged.add(region.maas_url)
+            for host in region_hosts:
+                if host.name in origins:
+                    msg = u'Host %s from %s is also present in %s' % (host.name, region.maas_url, origins[host.name])
+                    if strict:
+                        raise AnsibleError(msg)
+                    display.warning(u'%s, skipping it' % msg)
+                    continue
+                origins[host.name] = region.maas_url
+                hosts.append(host)
+
+        self._merged = merged
+        self._config.projection.report()
+        return hosts
+
+    def _region_deadline(self, region):
+        # seconds a region may take in total, by default the time all attempts of one request may take
+        if region.deadline is not None:
+            return float(region.deadline)
+        if region.timeout is not None:
+            return float(region.timeout) * (int(self._config.session_options['retries']) + 1)
+        return None
+
+    @staticmethod
+    def _run_detached(function, *args):
+        # like ThreadPoolExecutor.submit, but the daemon thread does not keep the process alive after a missed
+        # deadline, the executor's worker threads are joined when the interpreter exits
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        Thread(target=run, daemon=True).start()
+        return future
+
+    @staticmethod
+    def _referenced_names(expression, template=False):
+        # top level variables an expression (or a template) uses, None if that can not be determined
+        # the names are collected from the syntax tree, compiling it would fail on the filters and tests of ansible
+        if not isinstance(expression, string_types):
+            return set()
+        try:
+            tree = Environment().parse(expression if template else '{{ %s }}' % expression)
+        except Exception:
+            return None
+        # local names like loop variables are kept, passing a variable too many is harmless
+        return set(node.name for node in tree.find_all(nodes.Name) if node.ctx == 'load')
+
+    def _compile_rules(self):
+        # each constructed rule is evaluated on its own, which allows timing every rule separately
+        rules = []
+        for varname, expression in (self.get_option('compose') or {}).items():
+            rules.append(('compose %s' % varname, self._set_composite_vars, {varname: expression}, expression))
+        for group, conditional in (self.get_option('groups') or {}).items():
+            rules.append(('groups %s' % group, self._add_host_to_composed_groups, {group: conditional}, conditional))
+        for keyed in (self.get_option('keyed_groups') or []):
+            key = keyed.get('key') if isinstance(keyed, dict) else None
+            rules.append(('keyed_groups %s' % key, self._add_host_to_keyed_groups, [keyed], key))
+
+        names = set()
+        for rule in rules:
+            rule_names = self._referenced_names(rule[3])
+            if rule_names is None:
+                return rules, None
+            names.update(rule_names)
+        # the parent group of a keyed group is a template rendered with the same variables
+        for keyed in (self.get_option('keyed_groups') or []):
+            rule_names = self._referenced_names(keyed.get('parent_group'), template=True) if isinstance(keyed, dict) else set()
+            if rule_names is None:
+                return rules, None
+            names.update(rule_names)
+        return rules, names
+
+    def _populate(self, hosts, details_store=None):
         self.inventory.add_group('all')
         self.inventory.add_group('metal')
         self.inventory.add_group('virtual')
 
+        known_groups = set(['all', 'metal', 'virtual'])
+        strict = self.get_option('strict')
+        rules, names = self._compile_rules()
+        display.vvv(u'Variables used by constructed rules: %s' % ('all' if names is None else ', '.join(sorted(names))))
+        timed = display.verbosity >= 3
+        timings = [0.0] * len(rules)
+        count = 0
         try:
             for host in hosts:
-                if not self._config.include_vms and 'virtual' in host.groups():
+                if not self._config.include_vms and not host.metal:
                     continue
 
-                host.add_to_inventory(self.inventory, self._config.host)
-
-                strict = self.get_option('strict')
-                self._set_composite_vars(self.get_option('compose'),
-                                         host.attrs(),
-                                         host.name,
-                                         strict=strict)
-                self._add_host_to_composed_groups(self.get_option('groups'),
-                                                  host.attrs(),
-                                                  host.name,
-                                                  strict=strict)
-                self._add_host_to_keyed_groups(self.get_option('keyed_groups'),
-                                               host.attrs(),
-                                               host.name,
-                                               strict=strict)
+                host.add_to_inventory(self.inventory, self._config.host, known_groups)
+                if self._config.machine_vars == 'inline':
+                    self.inventory.set_variable(host.name, 'maas_machine', host.maas_data)
+                elif self._config.machine_vars == 'lazy':
+                    self.inventory.set_variable(host.name, 'maas_details_store', details_store)
+                count += 1
+
+                if not rules:
+                    continue
+                attrs = host.attrs()
+                # only pass the variables the rules reference to the templar
+                variables = attrs if names is None else dict((k, attrs[k]) for k in names if k in attrs)
+                for index, (label, method, rule, expression) in enumerate(rules):
+                    if timed:
+                        start_time = time()
+                        method(rule, variables, host.name, strict=strict)
+                        timings[index] += time() - start_time
+                    else:
+                        method(rule, variables, host.name, strict=strict)
         except Exception as e:
             raise AnsibleError('Unable to parse data from the MAAS API, this was the original exception: %s' %
                                to_native(e))
 
+        if timed and count:
+            for (label, method, rule, expression), timing in zip(rules, timings):
+                display.vvv(u'Constructed rule %s: %.3fs total, %.1fus per host' % (label, timing, timing / count * 1e6))
+
     def verify_file(self, path):
         """Return the possibly of a file being consumable by this plugin."""
         return (
             super(InventoryModule, self).verify_file(path) and
             path.endswith(('maas.yaml', 'maas.yml')))
 
-    def parse(self, inventory, loader, path, cache=True):
-        super(InventoryModule, self).parse(inventory, loader, path, cache)
-        self._read_config_data(path)
+    def _region(self, region):
+        if not isinstance(region, dict) or not region.get('maas_url'):
+            self._error('Invalid region %s, each region needs at least a maas_url' % region)
+        return AttrDict(
+            maas_url=str(region['maas_url']),
+            api_key=region.get('api_key'),
+            group_prefix=region.get('group_prefix') or '',
+            timeout=region.get('timeout'),
+            deadline=region.get('deadline'),
+        )
+
+    def _enrichment(self, enrichment):
+        if not isinstance(enrichment, dict) or not enrichment.get('name') or not enrichment.get('endpoint'):
+            self._error('Invalid enrich entry %s, each entry needs a name and an endpoint' % enrichment)
+        try:
+            str(enrichment['endpoint']).format(system_id='')
+        except (KeyError, IndexError, ValueError) as e:
+            self._error('Invalid enrich endpoint %s, only {system_id} can be used: %s' % (enrichment['endpoint'], e))
+        return AttrDict(
+            name=str(enrichment['name']),
+            endpoint=str(enrichment['endpoint']),
+            query=enrichment.get('query'),
+        )
 
+    def _load_config(self):
+        regions = self.get_option('regions') or [dict(maas_url=self.get_option('maas_url'),
+                                                      api_key=self.get_option('api_key'))]
         self._config = AttrDict(
             maas_url=self.get_option('maas_url'),
             api_key=self.get_option('api_key'),
+            regions=[self._region(r) for r in regions],
             include_vms=self.get_option('include_vms'),
             include_controllers=self.get_option('include_controllers'),
+            fetch_workers=self.get_option('fetch_workers'),
+            enrich=[self._enrichment(e) for e in self.get_option('enrich')],
+            enrich_workers=self.get_option('enrich_workers'),
+            session_options=dict((name, self.get_option(name)) for name in SESSION_OPTIONS if name != 'timeout'),
+            streaming=self.get_option('streaming'),
+            delta_refresh=self.get_option('cache_delta_refresh'),
+            delta_limit=self.get_option('cache_delta_refresh_limit'),
             host=self.get_option('host'),
+            machine_vars=self.get_option('machine_vars'),
+            filters=dict((f, self.get_option(f)) for f in MACHINE_FILTERS if self.get_option(f)),
+            projection=FieldProjection(self.get_option('fields'),
+                                       self.get_option('exclude_fields'),
+                                       measure=display.verbosity >= 3),
             debug=None,
         )
 
+    def _cache_source(self):
+        return [region.maas_url for region in self._config.regions]
+
+    def _fetch_fingerprint(self):
+        # entries fetched with other options that select the machines or their data are not used
+        options = dict(filters=self._config.filters, fields=self.get_option('fields'),
+                       exclude_fields=self.get_option('exclude_fields'), enrich=self.get_option('enrich'),
+                       include_vms=self._config.include_vms, include_controllers=self._config.include_controllers)
+        return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _cache_data(self, hosts):
+        header = dict(fingerprint=self._fetch_fingerprint())
+        if self._config.delta_refresh:
+            # skipped regions must not leave a cursor behind, a delta refresh would start without their hosts,
+            # the requests of a region that missed its deadline may still set one
+            header.update(cursors=dict((url, cursor) for url, cursor in dict(self._cursors).items() if url in self._merged),
+                          delta_refreshes=self._delta_refreshes)
+        return encode_hosts([host.to_dict() for host in hosts], Host.FIELDS, Host.SHARED_FIELDS, self._cache_source(),
+                            **header)
+
+    def _read_cache(self, cache_key, expired=False):
+        # returns the cached hosts and their age, raises KeyError if there is no usable cache entry
+        # with expired=True entries older than cache_timeout are returned as well
+        cached_data = self._cache[cache_key]
+        try:
+            rows = decode_hosts(cached_data)
+        except CacheFormatError as e:
+            display.vvv(u'Ignoring cache entry: %s' % to_native(e))
+            raise KeyError(cache_key)
+        if cached_data['source'] != self._cache_source():
+            display.vvv(u'Ignoring cache entry of %s' % ', '.join(cached_data['source']))
+            raise KeyError(cache_key)
+        if cached_data.get('fingerprint') != self._fetch_fingerprint():
+            display.vvv(u'Ignoring cache entry fetched with other options')
+            raise KeyError(cache_key)
+
+        age = time() - cached_data['created']
+        hard_timeout = self.get_option('cache_timeout')
+        if hard_timeout and age > hard_timeout and not expired:
+            raise KeyError(cache_key)
+        return [Host(host_data) for host_data in rows], age
+
+    def _delta_base(self, cache_key):
+        # event cursor and hosts per region of a cache entry that can be refreshed incrementally
+        if not self._config.delta_refresh:
+            return None
+        try:
+            # an expired entry is refreshed from its cursors as well, entries fetched with other options are not
+            hosts, age = self._read_cache(cache_key, expired=True)
+        except KeyError:
+            return None
+        entry = self._cache[cache_key]
+        refreshes = entry.get('delta_refreshes') or {}
+        base = {}
+        for url, cursor in (entry.get('cursors') or {}).items():
+            count = refreshes.get(url)
+            if count is None or count >= self._config.delta_limit:
+                display.vvv(u'%s was refreshed incrementally %s times in a row, fetching all machines' % (url, count))
+                continue
+            base[url] = (cursor, [host for host in hosts if host.region == url], count)
+        return base
+
+    def _refresh_detached(self, cache_key):
+        # double fork, so the refresh neither blocks this run nor becomes a zombie of it
+        try:
+            pid = os.fork()
+        except OSError as e:
+            display.warning(u'Unable to start background cache refresh: %s' % to_native(e))
+            return
+        if pid:
+            os.waitpid(pid, 0)
+            return
+
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            with self._cache_lock(cache_key, wait=False) as locked:
+                if not locked:
+                    # another process is refreshing the cache already
+                    return
+                if self._cache_fresh(cache_key):
+                    # another process refreshed the cache after this one read it
+                    return
+                self._cache[cache_key] = self._cache_data(self._fetch(self._delta_base(cache_key)))
+                self._cache.set_cache()
+        finally:
+            os._exit(0)
+
+    def _cache_fresh(self, cache_key):
+        # whether the entry another process may have written is younger than cache_soft_timeout
+        # the cache plugin keeps entries in memory, reload it to see what other processes wrote
+        self.load_cache_plugin()
+        try:
+            results, age = self._read_cache(cache_key)
+        except KeyError:
+            return False
+        soft_timeout = self.get_option('cache_soft_timeout')
+        return not soft_timeout or age <= soft_timeout
+
+    @contextmanager
+    def _cache_lock(self, cache_key, wait=True):
+        # exclusive lock on a cache entry, yields whether it was acquired
+        timeout = self.get_option('cache_lock_timeout')
+        if not timeout:
+            yield True
+            return
+
+        # cache_connection of e.g. redis is no directory
+        plugin = getattr(self._cache, '_plugin', None)
+        if isinstance(plugin, BaseFileCacheModule):
+            lock_dir = plugin._cache_dir
+        else:
+            lock_dir = os.path.expanduser(CACHE_LOCK_DIR)
+        try:
+            if not os.path.isdir(lock_dir):
+                os.makedirs(lock_dir)
+            fd = os.open(os.path.join(lock_dir, '.%s.lock' % cache_key), os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            display.warning(u'Unable to create cache lock in %s: %s' % (lock_dir, to_native(e)))
+            yield False
+            return
+
+        locked = waited = False
+        deadline = time() + timeout
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if not wait or time() >= deadline:
+                    break
+                if not waited:
+                    display.vvv(u'Waiting for another process to refresh the cache')
+                    waited = True
+                sleep(CACHE_LOCK_INTERVAL)
+
+            if locked:
+                # the owner is only informational, the lock itself dies with the process holding it
+                os.ftruncate(fd, 0)
+                os.write(fd, to_bytes(u'%d\n' % os.getpid()))
+            elif waited:
+                display.warning(u'Timed out after %ds waiting for the inventory cache lock, fetching hosts without it'
+                                % timeout)
+            yield locked
+        finally:
+            if locked:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _update_cache(self, cache_key, since, full=False):
+        # fetch the hosts and write them to the cache, unless another process did so after since
+        # with full=True all machines are fetched even if the cache could be refreshed incrementally
+        with self._cache_lock(cache_key):
+            if self.get_option('cache_lock_timeout'):
+                # the cache plugin keeps entries in memory, reload it to see what other processes wrote
+                self.load_cache_plugin()
+                try:
+                    results, age = self._read_cache(cache_key)
+                    if age <= time() - since:
+                        display.vvv(u'Using cache refreshed by another process')
+                        return results
+                except KeyError:
+                    pass
+
+            results = self._fetch(None if full else self._delta_base(cache_key))
+            self._cache[cache_key] = self._cache_data(results)
+            # write the cache before the lock is released, waiting processes read it right after
+            self._cache.set_cache()
+            return results
+
+    def _write_details(self, cache_key, hosts, generation):
+        # writes the machine data for the maas_details vars plugin unless the store matches the cache entry already
+        path = os.path.join(self.get_option('details_store'), '%s.jsonl' % cache_key)
+        if generation is None or store_generation(path) != generation:
+            start_time = time()
+            try:
+                write_store(path, dict((host.maas_id, host.maas_data) for host in hosts), generation or time())
+            except (IOError, OSError) as e:
+                raise AnsibleError('Unable to write the machine data to %s: %s' % (path, to_native(e)))
+            display.vvv(u'Wrote machine data of %d hosts to %s in %.2fs' % (len(hosts), path, time() - start_time))
+        return path
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+        self._load_config()
+
+        start_time = time()
         cache_key = self.get_cache_key(path)
         user_cache_setting = self.get_option('cache')
         attempt_to_read_cache = user_cache_setting and cache
@@ -232,18 +1049,24 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         if attempt_to_read_cache:
             try:
                 display.vvv(u'Attempting to read cache')
-                cached_data = self._cache[cache_key]
-                results = [Host(host_data) for host_data in cached_data]
+                results, age = self._read_cache(cache_key)
+                soft_timeout = self.get_option('cache_soft_timeout')
+                if soft_timeout and age > soft_timeout:
+                    display.vvv(u'Cache is stale (%ds old), refreshing it in the background' % age)
+                    self._refresh_detached(cache_key)
             except KeyError:
                 display.vvv(u'Cache needs update')
                 cache_needs_update = True
 
-        if cache_needs_update or not user_cache_setting:
-            results = self._fetch()
-
         if cache_needs_update:
-            cache_data = [host._data for host in results]
-            self._cache[cache_key] = cache_data
+            # a flushed cache (cache=False) is fetched in full
+            results = self._update_cache(cache_key, start_time, full=not cache)
+        elif not user_cache_setting:
+            results = self._fetch()
 
-        self._populate(results)
+        details_store = None
+        if self._config.machine_vars == 'lazy':
+            generation = self._cache[cache_key]['created'] if user_cache_setting else None
+            details_store = self._write_details(cache_key, results, generation)
+        self._populate(results, details_store)
 
@@ -24,7 +24,23 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import os
+import re
+import gc
 import json
+import fcntl
+import codecs
+import random
+import asyncio
+import hashlib
+import tempfile
+import threading
+import functools
+from time import time, sleep
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from requests_oauthlib import OAuth1Session
 from six.moves import urllib
 from ansible.utils.display import Display
@@ -32,15 +48,426 @@ from ansible.module_utils._text import to_native
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 display = Display()
 urlparse, urljoin = urllib.parse.urlparse, urllib.parse.urljoin
 
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# maximum number of keep-alive connections a session keeps open to its region
+DEFAULT_POOL_SIZE = 10
+# maximum number of GET responses kept by the response cache
+DEFAULT_CACHE_SIZE = 256
+# bytes of response bodies kept for conditional requests by each session
+DEFAULT_CONDITIONAL_SIZE = 16 * 1024 * 1024
+# the response cache is shared by all processes of a user, e.g. the forked workers of a play
+DEFAULT_CACHE_DIR = '~/.ansible/tmp/maas_api_cache'
+# state shared by all processes of a user, e.g. the circuit breakers of the regions
+DEFAULT_STATE_DIR = '~/.ansible/tmp/maas_api_state'
+# longest Retry-After in seconds that is honored, longer ones are shortened to it
+MAX_RETRY_AFTER = 120
+# response bodies logged at -vvvv are truncated to this many bytes
+MAX_LOGGED_BODY = 4096
+# the garbage collector is paused while bodies larger than this many bytes are decoded
+GC_PAUSE_BODY_SIZE = 1024 * 1024
+# directory the timing records of API calls are appended to if set, see the maas_timing callback plugin
+TIMING_SPOOL_ENV = 'ANSIBLE_MAAS_TIMING_SPOOL'
+
+# options of the api documentation fragment that configure an APISession, and their defaults
+SESSION_OPTIONS = dict(timeout=None, pool_size=DEFAULT_POOL_SIZE, cache_ttl=None, cache_size=DEFAULT_CACHE_SIZE,
+                       retries=5, retry_backoff=2, retry_jitter=1, retry_status=[],
+                       retry_idempotent_only=True, circuit_breaker=0, circuit_breaker_timeout=30,
+                       rate_limit=0, rate_burst=0, max_in_flight=0, conditional_get=False,
+                       conditional_get_size=DEFAULT_CONDITIONAL_SIZE)
+
 
 class APIError(Exception):
     pass
 
+
+_gc_lock = threading.Lock()
+_gc_pauses = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def _gc_paused():
+    # decoding a large body allocates millions of containers, which triggers full collections of the whole heap
+    # although decoded JSON cannot contain reference cycles
+    global _gc_pauses, _gc_was_enabled
+    with _gc_lock:
+        if _gc_pauses == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_pauses += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_pauses -= 1
+            if _gc_pauses == 0 and _gc_was_enabled:
+                gc.enable()
+
+_spool_lock = threading.Lock()
+_spool = None
+
+
+def record_timing(record):
+    ''' Appends record as a JSON line to the file of this process in the TIMING_SPOOL_ENV directory, if it is set. '''
+    global _spool
+    directory = os.environ.get(TIMING_SPOOL_ENV)
+    if not directory:
+        return
+    try:
+        with _spool_lock:
+            # each process appends to its own file, a forked child opens a new one
+            if _spool is None or _spool[:2] != (os.getpid(), directory):
+                path = os.path.join(directory, '%d.jsonl' % os.getpid())
+                _spool = (os.getpid(), directory, os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600))
+            os.write(_spool[2], (json.dumps(record) + '\n').encode('utf-8'))
+    except (IOError, OSError) as e:
+        display.vvv('Unable to record the timing of an API call: %s' % to_native(e))
+
+
+class JitterRetry(Retry):
+    ''' Retry that adds a random delay of up to jitter seconds to each backoff, so concurrent clients spread out.
+
+    Like the backoff itself the jitter starts with the second retry, the first one stays immediate.
+    '''
+    def __init__(self, jitter=0, **kwargs):
+        super(JitterRetry, self).__init__(**kwargs)
+        self.jitter = jitter
+
+    def new(self, **kwargs):
+        retry = super(JitterRetry, self).new(**kwargs)
+        retry.jitter = self.jitter
+        return retry
+
+    def get_backoff_time(self):
+        backoff = super(JitterRetry, self).get_backoff_time()
+        return backoff + random.uniform(0, self.jitter) if backoff > 0 else backoff
+
+    def parse_retry_after(self, retry_after):
+        return min(super(JitterRetry, self).parse_retry_after(retry_after), MAX_RETRY_AFTER)
+
+
+class SharedState():
+    ''' A small JSON document in a file that all processes of the user read and update under a lock. '''
+    def __init__(self, directory, name):
+        self.directory = os.path.expanduser(directory)
+        self.path = os.path.join(self.directory, '%s.json' % name)
+
+    @contextmanager
+    def _locked(self, operation):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, operation)
+            with os.fdopen(os.dup(fd), 'r+') as f:
+                try:
+                    state = json.load(f)
+                except ValueError:
+                    state = {}
+                yield f, state
+        finally:
+            os.close(fd)
+
+    def read(self):
+        with self._locked(fcntl.LOCK_SH) as (f, state):
+            return state
+
+    @contextmanager
+    def update(self):
+        # yields the state dict, changes to it are written when the block is left
+        with self._locked(fcntl.LOCK_EX) as (f, state):
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
+
+class CircuitBreaker():
+    ''' Fails calls to a region fast once it returned threshold server errors in a row.
+
+    The state is shared by all processes of the user. While the breaker is open every call raises an APIError,
+    after reset_timeout seconds calls are let through again and the next server error opens it again.
+    '''
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.state = SharedState(DEFAULT_STATE_DIR, 'breaker-%s' % hashlib.sha1(name.encode('utf-8')).hexdigest())
+        self.threshold = int(threshold)
+        self.reset_timeout = float(reset_timeout)
+
+    def check(self):
+        state = self.state.read()
+        remaining = state.get('open_until', 0) - time()
+        if remaining > 0:
+            raise APIError('%s returned %d server errors in a row, failing fast for another %.1fs'
+                           % (self.name, state['failures'], remaining))
+
+    def record(self, success):
+        if success and not self.state.read().get('failures'):
+            return
+        with self.state.update() as state:
+            if success:
+                state.update(failures=0, open_until=0)
+                return
+            state['failures'] = state.get('failures', 0) + 1
+            if state['failures'] >= self.threshold:
+                display.warning('Circuit breaker for %s opened after %d server errors in a row'
+                                % (self.name, state['failures']))
+                state['open_until'] = time() + self.reset_timeout
+
+
+class RateLimiter():
+    ''' Limits the rate and the concurrency of requests to a region for all processes of the user.
+
+    A token bucket allows rate requests per second with bursts of up to burst requests, and lock files allow at
+    most max_in_flight requests at the same time. Requests over the limits are queued, not rejected: a request
+    that finds the bucket empty reserves the next token and sleeps until it is due.
+    '''
+    def __init__(self, name, rate=0, burst=0, max_in_flight=0):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        self.rate = float(rate)
+        self.burst = float(burst) or max(1.0, self.rate)
+        self.bucket = SharedState(DEFAULT_STATE_DIR, 'bucket-%s' % digest) if self.rate else None
+        directory = os.path.expanduser(DEFAULT_STATE_DIR)
+        self.slots = [os.path.join(directory, 'slot-%s-%d.lock' % (digest, i)) for i in range(int(max_in_flight))]
+        self.stats = dict(calls=0, waited=0.0)
+
+    def _take_token(self):
+        with self.bucket.update() as state:
+            now = time()
+            tokens = min(self.burst, state.get('tokens', self.burst) + (now - state.get('updated', now)) * self.rate)
+            state.update(tokens=tokens - 1, updated=now)
+        if tokens < 1:
+            sleep((1 - tokens) / self.rate)
+
+    def _take_slot(self):
+        # returns the descriptor holding the lock of a free slot, released slots of crashed processes are free
+        delay = 0.01
+        while True:
+            for path in random.sample(self.slots, len(self.slots)):
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except (IOError, OSError):
+                    os.close(fd)
+            sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    @contextmanager
+    def limit(self):
+        # waits until a request may be sent, the request is in flight until the block is left
+        start_time = time()
+        if self.bucket is not None:
+            self._take_token()
+        slot = None
+        if self.slots:
+            if not os.path.isdir(os.path.dirname(self.slots[0])):
+                os.makedirs(os.path.dirname(self.slots[0]), 0o700)
+            slot = self._take_slot()
+        waited = time() - start_time
+        self.stats['calls'] += 1
+        self.stats['waited'] += waited
+        if waited >= 0.01:
+            display.vvvv('Waited %.2fs for the rate limit' % waited)
+        try:
+            yield
+        finally:
+            if slot is not None:
+                fcntl.flock(slot, fcntl.LOCK_UN)
+                os.close(slot)
+
+
+class CachedResponse():
+    ''' A response served by the ResponseCache, with the attributes of a response returned by APISession.call. '''
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.data = data
+
+
+class ResponseCache():
+    ''' Size bounded LRU cache of successful GET responses with a time to live per endpoint.
+
+    Entries are files in directory, so the cache is shared by all processes using it. ttl is the number of
+    seconds responses are kept, or a dict of endpoint prefixes (relative to the API base) and seconds in which
+    the longest matching prefix applies. Responses of endpoints without a matching prefix are not cached.
+    Any other method than GET invalidates all entries with a path that contains or is contained in its path,
+    compared by whole path segments.
+    '''
+    def __init__(self, directory, ttl, size=DEFAULT_CACHE_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.ttl = sorted(ttl.items() if isinstance(ttl, dict) else [('', ttl)], key=lambda i: -len(i[0]))
+        self.size = int(size)
+        self.stats = dict(hits=0, misses=0, invalidations=0)
+
+    def _ttl(self, path):
+        for prefix, ttl in self.ttl:
+            if path.startswith(prefix):
+                return float(ttl)
+        return 0
+
+    def _file(self, key, base, path):
+        # <base digest>.<key digest>.<quoted path>.json, invalidate matches entries by their name alone
+        return os.path.join(self.directory, '%s.%s.%s.json' % (self._digest(base), self._digest(key),
+                                                               urllib.parse.quote(path, safe='')))
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if name.endswith('.json')]
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get(self, key, path, base):
+        # returns the cached response of key or None, path is the endpoint the response was requested from
+        if self._ttl(path) <= 0:
+            return None
+        cache_file = self._file(key, base, path)
+        entry = self._read(cache_file)
+        if entry is None or entry['key'] != key or entry['expires'] < time():
+            self.stats['misses'] += 1
+            return None
+        try:
+            # the modification time orders the entries for eviction
+            os.utime(cache_file, None)
+        except OSError:
+            pass
+        self.stats['hits'] += 1
+        return CachedResponse(entry['status_code'], entry['data'])
+
+    def put(self, key, path, base, response):
+        ttl = self._ttl(path)
+        if ttl <= 0 or not response.ok:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        entry = dict(key=key, base=base, path=path, expires=time() + ttl,
+                     status_code=response.status_code, data=response.data)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, self._file(key, base, path))
+
+        entries = self._entries()
+        if len(entries) > self.size:
+            def mtime(path):
+                try:
+                    return os.path.getmtime(path)
+                except OSError:
+                    return 0
+            for old in sorted(entries, key=mtime)[:len(entries) - self.size]:
+                self._remove(old)
+
+    @staticmethod
+    def _normalize(path):
+        # without query and with a trailing slash, so machines/abc/ neither contains nor is contained in machines/abcd/
+        path = path.split('?', 1)[0].strip('/')
+        return path + '/' if path else ''
+
+    def invalidate(self, base, path):
+        # path is the endpoint of a request that may have changed data
+        prefix = self._digest(base) + '.'
+        path = self._normalize(path)
+        for cache_file in self._entries():
+            name = os.path.basename(cache_file)
+            if not name.startswith(prefix) or name.count('.') < 3:
+                continue
+            entry_path = self._normalize(urllib.parse.unquote(name[:-len('.json')].split('.', 2)[2]))
+            if entry_path.startswith(path) or path.startswith(entry_path):
+                self._remove(cache_file)
+                self.stats['invalidations'] += 1
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class ConditionalStore():
+    ''' Validators and decoded bodies of the last successful GET response of each URL, for conditional requests.
+
+    A request for a URL with an entry sends the ETag and Last-Modified validators of the entry. If the server
+    answers 304 Not Modified, or sends a body with the same hash when it doesn't support validators, the decoded
+    body of the entry is reused. The entries are bounded by size, the total number of bytes of their response
+    bodies. The least recently used ones are dropped, and larger responses are not kept at all.
+    '''
+    def __init__(self, size=DEFAULT_CONDITIONAL_SIZE):
+        self.size = int(size)
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = dict(not_modified=0, unchanged=0, bytes_saved=0, decode_saved=0.0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    @staticmethod
+    def headers(entry):
+        headers = {}
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, key, response, digest, data, decode_time):
+        entry = dict(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'),
+                     status_code=response.status_code, size=len(response.content), digest=digest, data=data,
+                     decode_time=decode_time)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous['size']
+            if entry['size'] > self.size:
+                return
+            self.entries[key] = entry
+            self.bytes += entry['size']
+            while self.bytes > self.size:
+                self.bytes -= self.entries.popitem(last=False)[1]['size']
+
+    def reuse(self, entry, not_modified):
+        # counts what reusing the data of entry saved and returns the data
+        with self.lock:
+            self.stats['not_modified' if not_modified else 'unchanged'] += 1
+            if not_modified:
+                self.stats['bytes_saved'] += entry['size']
+            self.stats['decode_saved'] += entry['decode_time']
+        return entry['data']
+
+
 class APISession():
-    def __init__(self, maas_url, api_key, api_version = '2.0'):
+    def __init__(self, maas_url, api_key, api_version = '2.0', timeout=None, pool_size=DEFAULT_POOL_SIZE,
+                 cache_ttl=None, cache_size=DEFAULT_CACHE_SIZE, retries=5, retry_backoff=2, retry_jitter=1,
+                 retry_status=(), retry_idempotent_only=True, circuit_breaker=0,
+                 circuit_breaker_timeout=30, rate_limit=0, rate_burst=0, max_in_flight=0, conditional_get=False,
+                 conditional_get_size=DEFAULT_CONDITIONAL_SIZE):
         try:
             client_key, token, token_secret = api_key.split(':')
         except Exception as e:
@@ -49,31 +476,333 @@ class APISession():
                                      signature_method='PLAINTEXT',
                                      resource_owner_key=token,
                                      resource_owner_secret=token_secret)
-        retry_strategy = Retry(total=5,backoff_factor=2)
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # connection errors are always retried, responses with retry_status only for idempotent methods by default
+        retry_strategy = JitterRetry(total=int(retries),
+                                     backoff_factor=float(retry_backoff),
+                                     jitter=float(retry_jitter),
+                                     status_forcelist=[int(status) for status in retry_status],
+                                     allowed_methods=Retry.DEFAULT_ALLOWED_METHODS if retry_idempotent_only else None,
+                                     raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=int(pool_size))
         self.session.mount("https://", adapter)
         self.session.mount("http://", adapter)
         self.base_url = urljoin(maas_url, '../')
         self.api_base = urljoin(self.base_url, '/MAAS/api/%s/' % api_version)
         self.headers = {'Accept': 'application/json'}
+        self.timeout = timeout
+        self.options = dict(timeout=timeout, pool_size=pool_size, cache_ttl=cache_ttl, cache_size=cache_size,
+                            retries=retries, retry_backoff=retry_backoff, retry_jitter=retry_jitter,
+                            retry_status=retry_status, retry_idempotent_only=retry_idempotent_only,
+                            circuit_breaker=circuit_breaker, circuit_breaker_timeout=circuit_breaker_timeout,
+                            rate_limit=rate_limit, rate_burst=rate_burst, max_in_flight=max_in_flight,
+                            conditional_get=conditional_get, conditional_get_size=conditional_get_size)
+        # responses are cached per API key, the data visible to different users may differ
+        self.cache_prefix = '%s %s ' % (hashlib.sha1(api_key.encode('utf-8')).hexdigest(), self.api_base)
+        self.cache = ResponseCache(DEFAULT_CACHE_DIR, cache_ttl, cache_size) if cache_ttl else None
+        self.breaker = CircuitBreaker(self.api_base, circuit_breaker, circuit_breaker_timeout) if circuit_breaker else None
+        self.limiter = RateLimiter(self.api_base, rate_limit, rate_burst, max_in_flight) \
+            if rate_limit or max_in_flight else None
+        self.conditional = ConditionalStore(conditional_get_size) if conditional_get else None
+        # added to the timing record of each call, e.g. the action and host of the task using the session
+        self.context = {}
+
+    def _template(self, url, query):
+        # the endpoint of url relative to the API base with the ids replaced, e.g. machines/{id}/?op=deploy
+        parsed = urlparse(url)
+        path = parsed.path[len(urlparse(self.api_base).path):].strip('/')
+        # MAAS endpoints alternate between collections and ids, e.g. nodes/{id}/blockdevices/{id}/
+        template = ''.join(('{id}' if i % 2 else segment) + '/' for i, segment in enumerate(path.split('/')) if path)
+        params = urllib.parse.parse_qsl(parsed.query) + list((query.items() if isinstance(query, dict) else query) or [])
+        op = dict(params).get('op')
+        return '%s?op=%s' % (template, op) if op else template
 
     def decode(self, response):
-        text = to_native(response.text)
+        # JSON is decoded straight from the body bytes, response.text would copy it and guess its charset
+        content = response.content
+        if len(content) < GC_PAUSE_BODY_SIZE:
+            return self._decode(response, content)
+        with _gc_paused():
+            return self._decode(response, content)
+
+    @staticmethod
+    def _decode(response, content):
+        if HAS_ORJSON:
+            try:
+                return orjson.loads(content)
+            except Exception:
+                # orjson is stricter than the json module, e.g. about invalid UTF-8
+                pass
         try:
-            return json.loads(text)
+            return json.loads(content)
         except Exception as e:
             display.vvv('Exception decoding JSON: %s' % to_native(e))
-            return text
+            return to_native(response.text)
+
+    @staticmethod
+    def _log_response(endpoint, response):
+        if display.verbosity < 4:
+            return
+        body = response.content
+        if len(body) > MAX_LOGGED_BODY:
+            body = b'%s... (%d bytes)' % (body[:MAX_LOGGED_BODY], len(body))
+        display.vvvv('Called %s: (%s) %s' % (endpoint, response.status_code, to_native(body, errors='replace')))
+
+    def iter_decode(self, response, chunk_size=64 * 1024):
+        ''' Decodes a JSON array from the response body item by item without loading the whole body. '''
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')()
+        chunks = response.iter_content(chunk_size)
+        buf, pos, eof = '', 0, False
+        state = 'start'
+
+        def read(buf, pos, need):
+            # read until at least need characters are buffered, parsing restarts at pos so this keeps retries linear
+            buf = buf[pos:]
+            while len(buf) < need:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return buf + text_decoder.decode(b'', final=True), True
+                buf += text_decoder.decode(chunk)
+            return buf, False
+
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos == len(buf):
+                if eof:
+                    break
+                buf, eof = read(buf, pos, 1)
+                pos = 0
+                continue
 
-    def call(self, method, endpoint, params={}):
+            char = buf[pos]
+            if state == 'start':
+                if char != '[':
+                    raise ValueError('Expected a JSON array but got: %s' % buf[pos:pos + 100])
+                state = 'first'
+                pos += 1
+                continue
+            if state in ('first', 'next') and char == ']':
+                state = 'done'
+                pos += 1
+                continue
+            if state == 'next':
+                if char != ',':
+                    raise ValueError('Expected , or ] at: %s' % buf[pos:pos + 100])
+                state = 'item'
+                pos += 1
+                continue
+            if state == 'done':
+                raise ValueError('Extra data after JSON array: %s' % buf[pos:pos + 100])
+
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                buf, eof = read(buf, pos, 2 * (len(buf) - pos))
+                pos = 0
+                continue
+            if not eof and isinstance(item, (int, float)) and (end == len(buf) or buf[end] in '0123456789.eE+-'):
+                # a number could continue in the next chunk
+                buf, eof = read(buf, pos, len(buf) - pos + 1)
+                pos = 0
+                continue
+            pos = end
+            state = 'next'
+            yield item
+
+        if state != 'done':
+            raise ValueError('Unexpected end of JSON array')
+
+    def _request(self, method, url, query, file_params, headers, stream, timing):
+        # the latency is measured from here, the time spent waiting for the rate limit doesn't count
+        timing['time'] = time()
+        return self.session.request(method, url, params=query, files=file_params, headers=headers,
+                                    stream=stream, timeout=self.timeout)
+
+    def _send(self, method, url, query, file_params, headers, stream, timing):
+        if self.limiter is None:
+            return self._request(method, url, query, file_params, headers, stream, timing)
+        with self.limiter.limit():
+            return self._request(method, url, query, file_params, headers, stream, timing)
+
+    @staticmethod
+    def _timed(items, response, timing):
+        # a streamed call is recorded once its body has been read
         try:
+            for item in items:
+                yield item
+        finally:
+            timing.update(latency=time() - timing['time'], bytes_in=response.raw.tell())
+            record_timing(timing)
+
+    def call(self, method, endpoint, params={}, query=None, stream=False, cached=True, conditional=True):
+        # query is added to the URL, use a list as value (or a list of tuples) to repeat a parameter
+        # with stream=True a successful response's data is an iterator over the items of the returned JSON array
+        # with cached=False a GET bypasses the response cache, e.g. to poll for changes
+        # the data of a response reused by conditional_get is the same object as before, it must not be modified
+        # with conditional=False a GET is not kept for conditional_get, e.g. when only a reduced copy of it is kept
+        try:
+            method = method.upper()
             url = urljoin(self.api_base, endpoint)
+            headers = self.headers
+            use_conditional = self.conditional is not None and method == 'GET' and not stream and conditional
+            stored = None
+            if use_conditional:
+                conditional_key = url + '?' + urllib.parse.urlencode(query or {}, doseq=True)
+                stored = self.conditional.get(conditional_key)
+                headers = dict(headers, **self.conditional.headers(stored))
+            if self.cache is not None:
+                path = urlparse(url).path[len(urlparse(self.api_base).path):]
+                cache_key = self.cache_prefix + url + '?' + urllib.parse.urlencode(query or {}, doseq=True)
+                if method == 'GET' and not stream and cached:
+                    cached_response = self.cache.get(cache_key, path, self.api_base)
+                    if cached_response is not None:
+                        display.vvvv('Called %s: (%s) cached response' % (endpoint, cached_response.status_code))
+                        return cached_response
+
             # MAAS expects multipart/form-data and doesn't like filenames
             file_params = {k: ('', v) for k, v in params.items()}
-            resp = self.session.request(method, url, files=file_params, headers=self.headers)
-            display.vvvv('Called %s: (%s) %s' % (endpoint, resp.status_code, resp.content))
-            resp.data = self.decode(resp)
+            if self.breaker is not None:
+                self.breaker.check()
+            timing = dict(self.context, method=method, endpoint=self._template(url, query), status=None,
+                          retries=None, bytes_out=None, bytes_in=None)
+            try:
+                resp = self._send(method, url, query, file_params, headers, stream, timing)
+            except Exception as e:
+                timing.update(latency=time() - timing.setdefault('time', time()), error=to_native(e))
+                record_timing(timing)
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                raise
+            retries = getattr(resp.raw, 'retries', None)
+            timing.update(status=resp.status_code, retries=len(retries.history) if retries else 0,
+                          bytes_out=len(resp.request.body or b''))
+            if self.breaker is not None:
+                self.breaker.record(resp.status_code < 500)
+            if self.cache is not None and method != 'GET':
+                self.cache.invalidate(self.api_base, path)
+            if stream and resp.ok:
+                display.vvvv('Called %s: (%s) streaming response' % (endpoint, resp.status_code))
+                resp.data = self._timed(self.iter_decode(resp), resp, timing)
+                return resp
+            timing.update(latency=time() - timing['time'], bytes_in=len(resp.content))
+            record_timing(timing)
+            if stored is not None and resp.status_code == 304:
+                display.vvvv('Called %s: (%s) not modified' % (endpoint, resp.status_code))
+                # callers see the response the validators belong to
+                resp.status_code = stored['status_code']
+                resp.data = self.conditional.reuse(stored, True)
+            elif use_conditional and resp.status_code == 200:
+                self._log_response(endpoint, resp)
+                digest = hashlib.sha1(resp.content).hexdigest()
+                if stored is not None and stored['digest'] == digest:
+                    resp.data = self.conditional.reuse(stored, False)
+                    self.conditional.put(conditional_key, resp, digest, resp.data, stored['decode_time'])
+                else:
+                    start_time = time()
+                    resp.data = self.decode(resp)
+                    self.conditional.put(conditional_key, resp, digest, resp.data, time() - start_time)
+            else:
+                self._log_response(endpoint, resp)
+                resp.data = self.decode(resp)
+            if self.cache is not None and method == 'GET':
+                self.cache.put(cache_key, path, self.api_base, resp)
             return resp
         except Exception as e:
             raise APIError('Exception occured while trying to call MAAS api. The original exception was: %s' % e)
 
+
+
+class AsyncAPISession():
+    ''' asyncio interface to an APISession.
+
+    Requests are made by the wrapped session in a thread pool, so signing, parameter encoding, retries and the
+    connection pool are the same as for blocking calls. At most concurrency calls run at the same time, the
+    session's pool_size should be at least as large to keep all of their connections alive.
+    '''
+    def __init__(self, session, concurrency=DEFAULT_POOL_SIZE):
+        self.session = session
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        # semaphores are bound to the event loop they are first used in
+        self._semaphores = WeakKeyDictionary()
+
+    def _semaphore(self, loop):
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    async def call(self, method, endpoint, params={}, query=None, cached=True):
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(loop):
+            return await loop.run_in_executor(self._executor, functools.partial(self.session.call, method, endpoint,
+                                                                                params, query, cached=cached))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_sessions_pid = os.getpid()
+
+
+def _reset_sessions():
+    # connections are bound to the process that opened them, a forked child starts with an empty registry
+    global _sessions, _sessions_lock, _sessions_pid
+    _sessions, _sessions_lock, _sessions_pid = {}, threading.Lock(), os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_sessions)
+
+
+def session_options(args):
+    ''' Returns the SESSION_OPTIONS set in args, e.g. the arguments of a task, with their defaults. '''
+    return dict((name, args.get(name, default)) for name, default in SESSION_OPTIONS.items())
+
+
+def get_session(maas_url, api_key, api_version='2.0', **options):
+    ''' Returns the APISession of maas_url, api_key and api_version shared by the whole process.
+
+    The session keeps its connections alive between calls, so every task and plugin using the same region
+    and key in this process reuses them instead of connecting again. options are SESSION_OPTIONS, a session
+    with different options replaces the shared one.
+    '''
+    if _sessions_pid != os.getpid():
+        _reset_sessions()
+    options = dict(SESSION_OPTIONS, **options)
+    key = (maas_url, api_key, api_version)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None or session.options != options:
+            display.vvvv('Opening API session to %s' % maas_url)
+            session = _sessions[key] = APISession(maas_url, api_key, api_version, **options)
+        return session
+
+
+def get_task_session(task, task_vars, result, maas_url, api_key, api_version='2.0'):
+    ''' Returns the shared APISession for the task of an action plugin, see get_session.
+
+    The session options are read from the task arguments. The timing records of the session's calls name the
+    task, and the statistics of the response cache, the rate limiter and the conditional requests are added to
+    the result dict of the task.
+    '''
+    session = get_session(maas_url, api_key, api_version, **session_options(task.args))
+    session.context = dict(action=task.action, task=task.get_name(), host=(task_vars or {}).get('inventory_hostname'))
+    # the counters are updated in place until the task returns
+    if session.cache is not None:
+        result['api_cache'] = session.cache.stats
+    if session.limiter is not None:
+        result['api_rate_limit'] = session.limiter.stats
+    if session.conditional is not None:
+        result['api_conditional'] = session.conditional.stats
+    return session
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import json
+import tempfile
+
+# bump whenever the layout of the store changes, stores of other versions are ignored
+STORE_VERSION = 1
+
+
+class StoreFormatError(Exception):
+    pass
+
+
+def write_store(path, records, generation):
+    ''' Writes records, a dict of key and JSON serializable record, to a single file store at path.
+
+    The first line of the file is an index of the byte offset and length of every record, the records follow
+    as one JSON document per line. The file is replaced atomically, readers see either the old or the new store.
+    '''
+    chunks, index, offset = [], {}, 0
+    for key, record in records.items():
+        chunk = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        index[key] = (offset, len(chunk))
+        chunks.append(chunk)
+        offset += len(chunk)
+    header = dict(version=STORE_VERSION, generation=generation, index=index)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or None, prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(header, separators=(',', ':')).encode('utf-8') + b'\n')
+            for chunk in chunks:
+                f.write(chunk)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def store_generation(path):
+    ''' Returns the generation of the store at path, or None if there is no readable store. '''
+    try:
+        return open_store(path).generation
+    except (IOError, OSError, StoreFormatError):
+        return None
+
+
+class DetailsStore(object):
+    ''' Reads single records of a store written by write_store, only the index is kept in memory. '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+            try:
+                header = json.loads(f.readline().decode('utf-8'))
+            except ValueError as e:
+                raise StoreFormatError('Corrupt store %s: %s' % (path, e))
+            self.base = f.tell()
+        if not isinstance(header, dict) or header.get('version') != STORE_VERSION:
+            raise StoreFormatError('Unsupported store format in %s' % path)
+        self.generation = header['generation']
+        self.index = header['index']
+        self.records = {}
+
+    def get(self, key):
+        ''' Returns the record of key, or None if the store has no such record. Records are read only once. '''
+        if key in self.records:
+            return self.records[key]
+        if key not in self.index:
+            return None
+        offset, length = self.index[key]
+        with open(self.path, 'rb') as f:
+            f.seek(self.base + offset)
+            record = json.loads(f.read(length).decode('utf-8'))
+        self.records[key] = record
+        return record
+
+
+_STORES = {}
+
+
+def open_store(path):
+    ''' Returns a DetailsStore of path, shared until the file is replaced. '''
+    stat = os.stat(path)
+    store = _STORES.get(path)
+    if store is None or store.stat != (stat.st_ino, stat.st_mtime, stat.st_size):
+        store = _STORES[path] = DetailsStore(path)
+    return store
@@ -24,25 +24,142 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import random
 import asyncio
-from time import time, sleep
+from collections import OrderedDict
+from time import monotonic, sleep
 from ansible.utils.display import Display
 
 display = Display()
 
+# number of system ids requested in one machines/ or events/ call by MachinePoller.wait_many
+WAIT_BATCH_SIZE = 100
+# maximum number of events requested in one events/ call (the MAAS API maximum)
+WAIT_EVENT_LIMIT = 1000
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
         self.__dict__ = self
 
 
+class PollSchedule:
+    ''' The times of the polls of a wait, and statistics about them.
+
+    The interval between polls starts at wait_interval and grows by the factor wait_backoff after every poll
+    that saw no status change, up to wait_max_interval. A status change and reaching the expected duration of
+    the wait reset it to wait_interval, so polls are most frequent when the wait is most likely to end. Each
+    interval varies randomly by up to the fraction wait_jitter. Intervals are measured from the start of the
+    previous poll, so the time requests take doesn't delay the schedule, and the deadline is on the monotonic
+    clock.
+    '''
+    def __init__(self, config, expected=None):
+        self.base = float(config.wait_interval)
+        self.backoff = max(1.0, float(config.get('wait_backoff') or 1))
+        self.max_interval = max(self.base, float(config.get('wait_max_interval') or self.base))
+        self.jitter = float(config.get('wait_jitter') or 0)
+        self.expected = expected
+        self.interval = self.base
+        self.start = monotonic()
+        self.deadline = self.start + float(config.wait_timeout)
+        self.polls = 0
+        # polls that only queried the event log of the machines
+        self.event_queries = 0
+        self.request_time = 0.0
+        self.last_poll = self.previous_poll = None
+        self.status = None
+
+    def polled(self, started, status):
+        # records a poll that was sent at started and saw status
+        now = monotonic()
+        self.polls += 1
+        self.request_time += now - started
+        self.previous_poll, self.last_poll = self.last_poll, started
+        expected_reached = self.expected is not None and self.previous_poll is not None and \
+            self.previous_poll - self.start < self.expected <= started - self.start
+        if self.polls == 1:
+            pass
+        elif status != self.status or expected_reached:
+            self.interval = self.base
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        self.status = status
+
+    def delay(self):
+        # seconds until the next poll is due, None once the deadline has passed
+        now = monotonic()
+        if now >= self.deadline:
+            return None
+        interval = self.interval
+        if self.expected is not None and now - self.start < self.expected:
+            # don't skip past the expected end of the wait
+            interval = min(interval, max(self.base, self.start + self.expected - self.last_poll))
+        interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        # the last poll happens at the deadline
+        return max(0.0, min(self.last_poll + interval, self.deadline) - now)
+
+    def stats(self):
+        # wasted_latency is how long the final status may have gone unnoticed, the time since the previous poll
+        return dict(polls=self.polls,
+                    event_queries=self.event_queries,
+                    elapsed=round(monotonic() - self.start, 3),
+                    request_time=round(self.request_time, 3),
+                    wasted_latency=round(self.last_poll - self.previous_poll if self.previous_poll else 0.0, 3))
+
+
 class MachinePoller:
     def __init__(self, config, session):
+        # session is an APISession for wait and an AsyncAPISession for wait_async
         self.config = config
         self.session = session
+        # the PollSchedule statistics of the waits by system id
+        self.stats = {}
 
-    def wait(self, system_id, target, acceptable_status, numeric_status=False):
-        machine_endpoint = 'machines/%s/' % system_id
+    def _expected(self, target):
+        # the expected duration of waiting for target from wait_expected, a number or a dict of status names
+        expected = self.config.get('wait_expected')
+        if isinstance(expected, dict):
+            names = set(str(t).lower() for t in target)
+            durations = [float(seconds) for status, seconds in expected.items() if str(status).lower() in names]
+            return max(durations) if durations else None
+        return float(expected) if expected else None
+
+    def _follow_events(self):
+        return self.config.get('wait_mode', 'poll') == 'events'
+
+    def _event_cursor(self):
+        # the id of the newest event, waiting for events starts after it
+        response = self.session.call('GET', 'events/', query=dict(op='query', level='DEBUG', limit=1), cached=False)
+        if not response.ok:
+            display.vvv('Querying the newest event failed with status %s' % response.status_code)
+            return 0
+        return max([event['id'] for event in response.data['events']] or [0])
+
+    def _events(self, cursors, system_ids):
+        # returns the system_ids with events after their cursor and advances the cursors
+        changed = set()
+        for i in range(0, len(system_ids), WAIT_BATCH_SIZE):
+            batch = system_ids[i:i + WAIT_BATCH_SIZE]
+            response = self.session.call('GET', 'events/', query=dict(op='query', level='DEBUG', id=batch,
+                                                                      after=min(cursors[s] for s in batch),
+                                                                      limit=WAIT_EVENT_LIMIT), cached=False)
+            if not response.ok:
+                # the machines are requested instead
+                display.vvv('Querying events failed with status %s' % response.status_code)
+                changed.update(batch)
+                continue
+            events = response.data['events']
+            for event in events:
+                if event.get('node') in cursors and event['id'] > cursors[event['node']]:
+                    changed.add(event['node'])
+            newest = max([event['id'] for event in events] or [0])
+            for system_id in batch:
+                cursors[system_id] = max(cursors[system_id], newest)
+        display.vvv('Events of %d of %d machines' % (len(changed), len(system_ids)))
+        return [system_id for system_id in system_ids if system_id in changed]
+
+    @staticmethod
+    def _status_sets(target, acceptable_status):
         try:
             iterator = iter(target)
         except TypeError: # not iterable
@@ -57,36 +174,151 @@ class MachinePoller:
         acceptable_status = acceptable_status.union(target)
 
         display.vvv('Target status: %s, acceptable status: %s' % (target, acceptable_status))
+        return target, acceptable_status
 
-        def poll_machine():
-            wait_response = self.session.call('GET', machine_endpoint)
-            if numeric_status:
-                status = int(wait_response.data.get('status', 0))
-            else:
-                status = wait_response.data.get('status_name', '').lower()
-
-            display.vvv('Waiting for machine %s: status %s, target %s (%s)' % (system_id, status, target, target == status))
-            data = wait_response.data
-            if not wait_response.ok or not status in acceptable_status:
-               return (True, 'Waiting for machine failed. Last status: %s' % status, data)
-            elif status in target:
-               return (True, None, data)
-            elif status in acceptable_status:
-               return (False, None, data)
+    @staticmethod
+    def _evaluate(system_id, ok, data, target, acceptable_status, numeric_status):
+        # returns whether waiting is done, the error if it failed and the machine data
+        if numeric_status:
+            status = int(data.get('status', 0))
+        else:
+            status = data.get('status_name', '').lower()
+
+        display.vvv('Waiting for machine %s: status %s, target %s (%s)' % (system_id, status, target, target == status))
+        if not ok or not status in acceptable_status:
+           return (True, 'Waiting for machine failed. Last status: %s' % status, data)
+        elif status in target:
+           return (True, None, data)
+        elif status in acceptable_status:
+           return (False, None, data)
+        else:
+           return (True, 'Waiting for machine failed. Last status: %s' % status, data)
+
+    def wait(self, system_id, target, acceptable_status, numeric_status=False):
+        machine_endpoint = 'machines/%s/' % system_id
+        target, acceptable_status = self._status_sets(target, acceptable_status)
+
+        # following events, the machine is only requested after it had events or wait_max_interval passed
+        events = self._follow_events()
+        cursors = {system_id: self._event_cursor()} if events else None
+        schedule = PollSchedule(self.config, self._expected(target))
+        confirmed = None
+        while True:
+            started = monotonic()
+            if events and confirmed is not None and started - confirmed < schedule.max_interval \
+                    and not self._events(cursors, [system_id]):
+                schedule.event_queries += 1
+                schedule.polled(started, data.get('status') if isinstance(data, dict) else None)
+                self.stats[system_id] = schedule.stats()
             else:
-               return (True, 'Waiting for machine failed. Last status: %s' % status, data)
-        
-        start_time = time()
-        done = False
-        while not done:
-            done, error, data = poll_machine()
+                confirmed = started
+                wait_response = self.session.call('GET', machine_endpoint, cached=False)
+                done, error, data = self._evaluate(system_id, wait_response.ok, wait_response.data, target,
+                                                   acceptable_status, numeric_status)
+                schedule.polled(started, data.get('status') if isinstance(data, dict) else None)
+                self.stats[system_id] = schedule.stats()
+                display.vvv('Waiting: done (%s), error is None (%s)' % (done, error is None))
+                if error is not None:
+                    return (error, data)
+                if done:
+                    return None, data
+
+            delay = schedule.delay()
+            if delay is None:
+                return ('Timeout while waiting for machine.', data)
+            sleep(delay)
+
+    async def wait_async(self, system_id, target, acceptable_status, numeric_status=False):
+        ''' Coroutine version of wait, many machines can be awaited concurrently with asyncio.gather.
+
+        The machine is always polled, wait_mode events is only supported by wait and wait_many.
+        '''
+        machine_endpoint = 'machines/%s/' % system_id
+        target, acceptable_status = self._status_sets(target, acceptable_status)
+
+        schedule = PollSchedule(self.config, self._expected(target))
+        while True:
+            started = monotonic()
+            wait_response = await self.session.call('GET', machine_endpoint, cached=False)
+            done, error, data = self._evaluate(system_id, wait_response.ok, wait_response.data, target,
+                                               acceptable_status, numeric_status)
+            schedule.polled(started, data.get('status') if isinstance(data, dict) else None)
+            self.stats[system_id] = schedule.stats()
             display.vvv('Waiting: done (%s), error is None (%s)' % (done, error is None))
             if error is not None:
                 return (error, data)
-            if time() - start_time > self.config.wait_timeout:
+            if done:
+                return None, data
+
+            delay = schedule.delay()
+            if delay is None:
                 return ('Timeout while waiting for machine.', data)
+            await asyncio.sleep(delay)
+
+    def wait_many(self, machines, numeric_status=False):
+        ''' Waits for any number of machines with one machines/ listing per WAIT_BATCH_SIZE machines and interval.
+
+        machines is a list of dicts with the system_id, target and acceptable_status of each machine, the rules
+        are applied to each machine like by wait. Returns a dict of the system ids and (error, data) tuples, the
+        statistics of all polls are kept in stats under None.
+        '''
+        rules = OrderedDict((m['system_id'], self._status_sets(m['target'], m.get('acceptable_status', [])))
+                            for m in machines)
+        results, latest = {}, {}
+
+        # following events, only the machines with events are requested until wait_max_interval passed
+        events = self._follow_events()
+        cursors = dict.fromkeys(rules, self._event_cursor()) if events else None
+        expected = [self._expected(target) for target, acceptable_status in rules.values()]
+        schedule = PollSchedule(self.config, max(expected) if expected and None not in expected else None)
+        confirmed = None
+        while True:
+            started = monotonic()
+            pending = [system_id for system_id in rules if system_id not in results]
+            if events and confirmed is not None and started - confirmed < schedule.max_interval:
+                schedule.event_queries += 1
+                requested = self._events(cursors, pending)
+            else:
+                confirmed = started
+                requested = pending
+            for i in range(0, len(requested), WAIT_BATCH_SIZE):
+                batch = requested[i:i + WAIT_BATCH_SIZE]
+                response = self.session.call('GET', 'machines/', query=dict(id=batch), cached=False)
+                if not response.ok:
+                    for system_id in batch:
+                        results[system_id] = ('Listing the machines failed with status %s: %s'
+                                              % (response.status_code, response.data), latest.get(system_id))
+                    continue
+                listed = dict((machine['system_id'], machine) for machine in response.data)
+                for system_id in batch:
+                    if system_id not in listed:
+                        results[system_id] = ('Machine %s not found' % system_id, latest.get(system_id))
+                        continue
+                    target, acceptable_status = rules[system_id]
+                    done, error, data = self._evaluate(system_id, True, listed[system_id], target,
+                                                       acceptable_status, numeric_status)
+                    latest[system_id] = data
+                    if done:
+                        results[system_id] = (error, data)
+
+            # a machine finishing or changing its status counts as a status change of the whole wait
+            schedule.polled(started, sorted((system_id, data.get('status')) for system_id, data in latest.items()
+                                            if system_id not in results))
+            for system_id in pending:
+                if system_id in results:
+                    self.stats[system_id] = schedule.stats()
+            self.stats[None] = schedule.stats()
 
-            if not done:
-                sleep(self.config.wait_interval)
+            pending = [system_id for system_id in rules if system_id not in results]
+            display.vvv('Waiting for %d of %d machines' % (len(pending), len(rules)))
+            if not pending:
+                break
+            delay = schedule.delay()
+            if delay is None:
+                for system_id in pending:
+                    results[system_id] = ('Timeout while waiting for machine.', latest.get(system_id))
+                    self.stats[system_id] = schedule.stats()
+                break
+            sleep(delay)
 
-        return None, data
+        return OrderedDict((system_id, results[system_id]) for system_id in rules)
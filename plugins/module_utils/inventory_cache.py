@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import zlib
+import base64
+from time import time
+
+# bump whenever the layout of the payload changes, entries of other versions are ignored
+CACHE_VERSION = 2
+
+
+class CacheFormatError(Exception):
+    pass
+
+
+def encode_hosts(rows, fields, shared_fields, source, **header):
+    ''' Encodes a list of host dicts into a versioned, column-wise and compressed cache entry.
+
+    Values of the shared_fields columns are stored once in a lookup table and referenced by index. Fields a row
+    doesn't have are stored as None.
+    '''
+    columns = {}
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        if field in shared_fields:
+            table, index, keys = [], {}, []
+            for value in values:
+                key = json.dumps(value, sort_keys=True)
+                if key not in index:
+                    index[key] = len(table)
+                    table.append(value)
+                keys.append(index[key])
+            columns[field] = dict(table=table, index=keys)
+        else:
+            columns[field] = dict(values=values)
+
+    payload = json.dumps(dict(count=len(rows), columns=columns), separators=(',', ':'))
+    entry = dict(header)
+    entry.update(
+        version=CACHE_VERSION,
+        source=source,
+        created=time(),
+        count=len(rows),
+        payload=base64.b64encode(zlib.compress(payload.encode('utf-8'), 6)).decode('ascii'),
+    )
+    return entry
+
+
+def decode_hosts(entry):
+    ''' Returns the host dicts of a cache entry created by encode_hosts, raises CacheFormatError if it is unusable. '''
+    if not isinstance(entry, dict) or entry.get('version') != CACHE_VERSION:
+        raise CacheFormatError('Unsupported cache format')
+    try:
+        payload = json.loads(zlib.decompress(base64.b64decode(entry['payload'], validate=True)).decode('utf-8'))
+        count = payload['count']
+        rows = [{} for _ in range(count)]
+        for field, column in payload['columns'].items():
+            if 'table' in column:
+                table = column['table']
+                values = [table[i] for i in column['index']]
+            else:
+                values = column['values']
+            if len(values) != count:
+                raise ValueError('column %s has %d of %d values' % (field, len(values), count))
+            for row, value in zip(rows, values):
+                row[field] = value
+    except Exception as e:
+        raise CacheFormatError('Corrupt cache entry: %s' % e)
+    return rows
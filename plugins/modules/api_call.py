@@ -88,5 +88,18 @@ success:
     description: True if the call returned a 2xx status code
     returned: always
     type: bool
+api_cache:
+    description: Hits, misses and invalidations of the response cache during the task
+    returned: when I(cache_ttl) is set
+    type: dict
+api_rate_limit:
+    description: Number of requests and the seconds they waited for I(rate_limit) and I(max_in_flight) during the task
+    returned: when I(rate_limit) or I(max_in_flight) is set
+    type: dict
+api_conditional:
+    description: "Responses that were not modified or unchanged, and the bytes and seconds of decoding reusing their
+        data saved during the task"
+    returned: when I(conditional_get) is set
+    type: dict
 '''
 
@@ -57,9 +57,10 @@ options:
         description: A comment for the event log.
         type: str
     wait:
-        description: If true, wait until the deploy is complete.
+        description: "If true, wait until the deploy is complete. Set to I(no) to return right after the deployment
+            started, e.g. to wait for many machines at once with M(heilerich.maas.wait_many)."
         type: bool
-        default: no
+        default: yes
     install_kvm:
         description: Prepare and register the machine for use as a KVM based virtual machine host in MAAS.
         type: bool
@@ -91,5 +92,24 @@ machine_info:
     description: the MAAS machine info for the deployed machine
     returned: always
     type: dict
+wait_stats:
+    description: "Number of I(polls) and of those that only queried events (I(event_queries)), seconds I(elapsed),
+        seconds spent in requests (I(request_time)) and I(wasted_latency), the seconds since the previous poll for
+        which the final status may have gone unnoticed"
+    returned: when I(wait) is set and the machine was deployed
+    type: dict
+api_cache:
+    description: Hits, misses and invalidations of the response cache during the task
+    returned: when I(cache_ttl) is set
+    type: dict
+api_rate_limit:
+    description: Number of requests and the seconds they waited for I(rate_limit) and I(max_in_flight) during the task
+    returned: when I(rate_limit) or I(max_in_flight) is set
+    type: dict
+api_conditional:
+    description: "Responses that were not modified or unchanged, and the bytes and seconds of decoding reusing their
+        data saved during the task"
+    returned: when I(conditional_get) is set
+    type: dict
 '''
 
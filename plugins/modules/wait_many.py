@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+---
+module: heilerich.maas.wait_many
+short_description: Waits for many machines at once
+description:
+    - Waits for any number of machines to change their status to the desired values.
+    - "Unlike looping over M(heilerich.maas.wait), the API is polled with a single listing of up to 100 machines
+      per interval, so the number of requests doesn't grow with the number of machines."
+    - The task fails if any machine fails, the results of all machines are returned either way.
+extends_documentation_fragment:
+    - heilerich.maas.api
+    - heilerich.maas.wait
+options:
+    machines:
+        description: "List of machines to wait for. Each is either the ID of the system in MAAS or a dict with a
+            I(system_id) and optionally a I(target) and I(acceptable_status), which override the ones of the task
+            for this machine."
+        type: list
+        elements: raw
+        required: true
+    target:
+        description: The desired machine status (e.g. 'ready') of the machines without their own target
+        type: [str, list]
+        required: false
+    acceptable_status:
+        description: "List of acceptable status (e.g. ['comissioning']) of the machines without their own list. If
+            a machine's status changes to a status that is neither its target nor acceptable it has failed."
+        type: list
+        required: false
+author:
+- Felix Heilmeyer <code@fehe.eu>
+'''
+
+EXAMPLES = r'''
+# Deploy all machines of the play without waiting, then wait for all of them with one task
+- hosts: all
+  gather_facts: no
+  tasks:
+  - name: Deploy the machines
+    heilerich.maas.deploy:
+      system_id: '{{ maas_id }}'
+      wait: no
+    delegate_to: localhost
+
+  - name: Wait for all machines to be deployed
+    heilerich.maas.wait_many:
+      machines: "{{ ansible_play_hosts | map('extract', hostvars, 'maas_id') | list }}"
+      target: 'deployed'
+      acceptable_status: ['deploying']
+      wait_interval: 20
+      wait_timeout: 1800
+    run_once: yes
+    delegate_to: localhost
+
+# Machines can have their own rules
+- name: Wait for a commissioning and a releasing machine
+  heilerich.maas.wait_many:
+    machines:
+      - system_id: 'abc123'
+        target: 'ready'
+        acceptable_status: ['commissioning', 'testing']
+      - system_id: 'def456'
+        target: 'ready'
+        acceptable_status: ['releasing', 'disk erasing']
+  delegate_to: localhost
+'''
+
+RETURN = r'''
+machines:
+    description: "The result of each machine by system id: whether waiting I(failed), the error I(msg) and the
+        last MAAS I(machine) info and the I(wait_stats) of the machine"
+    returned: always
+    type: dict
+wait_stats:
+    description: "Number of I(polls) and of those that only queried events (I(event_queries)), seconds I(elapsed),
+        seconds spent in requests (I(request_time)) and I(wasted_latency), the seconds since the previous poll for
+        which the final status may have gone unnoticed"
+    returned: always
+    type: dict
+api_cache:
+    description: Hits, misses and invalidations of the response cache during the task
+    returned: when I(cache_ttl) is set
+    type: dict
+api_rate_limit:
+    description: Number of requests and the seconds they waited for I(rate_limit) and I(max_in_flight) during the task
+    returned: when I(rate_limit) or I(max_in_flight) is set
+    type: dict
+api_conditional:
+    description: "Responses that were not modified or unchanged, and the bytes and seconds of decoding reusing their
+        data saved during the task"
+    returned: when I(conditional_get) is set
+    type: dict
+'''
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: maas_details
+    author:
+      - Felix Heilmeyer <code@fehe.eu>
+    short_description: Loads the MAAS machine data of inventory hosts on demand.
+    requirements:
+        - Enabled in configuration, e.g. C(vars_plugins_enabled = host_group_vars,heilerich.maas.maas_details)
+    description:
+        - "Companion of the I(heilerich.maas.maas_machines) inventory plugin with I(machine_vars=lazy). Sets the
+          I(maas_machine) variable of a host to its MAAS machine data."
+        - "The data is read from the file the inventory plugin wrote, one host at a time when the variables of the
+          host are needed. Hosts without I(maas_id) and I(maas_details_store) variables are ignored."
+    options:
+        stage:
+            ini:
+                - key: stage
+                  section: vars_maas_details
+            env:
+                - name: ANSIBLE_VARS_PLUGIN_STAGE
+    extends_documentation_fragment:
+        - vars_plugin_staging
+'''
+
+from ansible.errors import AnsibleError
+from ansible.inventory.host import Host
+from ansible.module_utils._text import to_native
+from ansible.plugins.vars import BaseVarsPlugin
+from ansible_collections.heilerich.maas.plugins.module_utils.details_store import open_store, StoreFormatError
+
+
+class VarsModule(BaseVarsPlugin):
+
+    def get_vars(self, loader, path, entities, cache=True):
+        if not isinstance(entities, list):
+            entities = [entities]
+
+        data = {}
+        for entity in entities:
+            if not isinstance(entity, Host):
+                continue
+            maas_id = entity.vars.get('maas_id')
+            store_path = entity.vars.get('maas_details_store')
+            if not maas_id or not store_path:
+                continue
+            try:
+                record = open_store(to_native(store_path)).get(to_native(maas_id))
+            except (IOError, OSError, StoreFormatError) as e:
+                raise AnsibleError('Unable to read the MAAS machine data of %s: %s' % (entity.name, to_native(e)))
+            if record is not None:
+                data['maas_machine'] = record
+        return data
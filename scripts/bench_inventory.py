@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Benchmark suite for the maas_machines inventory plugin.
+
+Synthetic fleets (see maas_fixtures.py) are served by a local stand-in MAAS server, and the
+hot paths of the plugin are timed separately for each fleet size. The results are printed
+as JSON, so they can be stored and compared over time.
+
+The collection must be importable, either install it with scripts/install.sh or point
+ANSIBLE_COLLECTIONS_PATH to a directory containing ansible_collections/heilerich/maas.
+
+    python scripts/bench_inventory.py --sizes 100,1000,10000,50000 --output bench.json
+'''
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from time import time
+from ansible import __version__ as ansible_version
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins import loader
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from maas_fixtures import StandInMAAS, fleet
+
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # before ansible-core 2.19 all templates are trusted
+    def trust_as_template(value):
+        return value
+
+
+CONSTRUCTED = dict(
+    strict=True,
+    compose=dict(arch=trust_as_template('architecture'), first_ip=trust_as_template("ip_addresses | first | default('')")),
+    groups=dict(ready=trust_as_template("status_name == 'Ready'")),
+    keyed_groups=[dict(prefix='arch', key=trust_as_template('architecture'))],
+)
+
+
+def load_plugin(maas_url, cache_dir, constructed=False):
+    plugin = loader.inventory_loader.get('heilerich.maas.maas_machines')
+    options = dict(plugin='heilerich.maas.maas_machines', maas_url=maas_url, api_key='x:y:z',
+                   include_controllers=True, cache=True, cache_plugin='jsonfile', cache_connection=cache_dir)
+    if constructed:
+        options.update(CONSTRUCTED)
+    plugin.set_options(direct=options)
+    plugin._load_config()
+    plugin.load_cache_plugin()
+    return plugin
+
+
+def best_of(rounds, func):
+    timings = []
+    for _ in range(rounds):
+        start_time = time()
+        result = func()
+        timings.append(time() - start_time)
+    return min(timings), result
+
+
+def bench_size(machines, rounds, constructed):
+    payloads = fleet(machines)
+    server = StandInMAAS(payloads).start()
+    cache_dir = tempfile.mkdtemp(prefix='maas-bench-')
+    try:
+        plugin = load_plugin(server.url, cache_dir, constructed)
+        Host = sys.modules[plugin.__class__.__module__].Host
+        result = dict(machines=machines, payload_bytes=sum(len(body) for body in server.encoded.values()))
+
+        result['fetch'], hosts = best_of(rounds, plugin._fetch)
+        result['from_machine'], _ = best_of(rounds, lambda: [Host.from_machine(m, ['machines']) for m in payloads['machines/']])
+
+        def populate():
+            plugin.inventory = InventoryData()
+            plugin.loader = DataLoader()
+            plugin._populate(hosts)
+        result['populate'], _ = best_of(rounds, populate)
+
+        def cache_write():
+            plugin._cache['bench'] = plugin._cache_data(hosts)
+            plugin._cache.set_cache()
+        result['cache_write'], _ = best_of(rounds, cache_write)
+        result['cache_bytes'] = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir))
+
+        def cache_read():
+            plugin.load_cache_plugin()
+            return plugin._read_cache('bench')
+        result['cache_read'], _ = best_of(rounds, cache_read)
+        result['hosts'] = len(hosts)
+        return result
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the maas_machines inventory plugin')
+    parser.add_argument('--sizes', default='100,1000,10000,50000', help='comma separated numbers of machines')
+    parser.add_argument('--rounds', type=int, default=3, help='each timing is the best of this many rounds')
+    parser.add_argument('--constructed', action='store_true', help='evaluate a set of compose/groups/keyed_groups rules')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    if hasattr(loader, 'init_plugin_loader'):
+        loader.init_plugin_loader()
+    report = dict(
+        created=time(),
+        python=platform.python_version(),
+        ansible=ansible_version,
+        rounds=args.rounds,
+        constructed=args.constructed,
+        results=[],
+    )
+    for size in [int(s) for s in args.sizes.split(',')]:
+        result = bench_size(size, args.rounds, args.constructed)
+        sys.stderr.write('%(machines)d machines: fetch %(fetch).3fs, from_machine %(from_machine).3fs, '
+                         'populate %(populate).3fs, cache write %(cache_write).3fs, cache read %(cache_read).3fs\n' % result)
+        report['results'].append(result)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# MIT License
+# 
+# Copyright (c) 2021 Felix Heilmeyer
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+Synthetic MAAS API payloads and a local stand-in server for them.
+
+Run it directly to serve a fleet on http://127.0.0.1:5240/MAAS/, e.g.
+
+    python scripts/maas_fixtures.py --machines 10000
+'''
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import hashlib
+import random
+import argparse
+import threading
+import time
+from six.moves import urllib
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+STATUS = [(4, 'Ready'), (6, 'Deployed'), (10, 'Allocated'), (9, 'Deploying'), (11, 'Failed deployment')]
+ZONES = ['default', 'rack-a', 'rack-b', 'rack-c']
+POOLS = ['default', 'compute', 'storage']
+TAGS = ['virtual', 'gpu', 'nvme', 'ssd', 'hdd', 'sriov', 'bmc']
+# nodes/<system_id>/<listing>/ endpoints and the machine keys they are served from
+NODE_LISTINGS = dict(interfaces='interface_set', blockdevices='physicalblockdevice_set')
+
+
+def system_id(kind, i):
+    return '%s%05x' % (kind[0], i)
+
+
+def interface(rnd, i, n):
+    mac = '52:54:00:%02x:%02x:%02x' % (i >> 16 & 0xff, i >> 8 & 0xff, (i + n) & 0xff)
+    return dict(
+        id=i * 4 + n,
+        name='eno%d' % (n + 1),
+        type='physical',
+        mac_address=mac,
+        enabled=True,
+        effective_mtu=1500,
+        vlan=dict(id=5001 + n, vid=0, name='untagged', fabric='fabric-%d' % n, mtu=1500, dhcp_on=n == 0),
+        links=[dict(id=i * 4 + n, mode='auto', subnet=dict(id=n + 1, cidr='10.%d.0.0/16' % n, name='10.%d.0.0/16' % n))],
+        params='',
+        tags=[],
+        resource_uri='/MAAS/api/2.0/nodes/%s/interfaces/%d/' % (system_id('machine', i), i * 4 + n),
+    )
+
+
+def block_device(rnd, i, n):
+    return dict(
+        id=i * 4 + n,
+        name='sd%s' % chr(ord('a') + n),
+        model='SAMSUNG MZ7LH960',
+        serial='S4%08d' % (i * 4 + n),
+        size=960197124096,
+        block_size=512,
+        tags=['ssd'],
+        id_path='/dev/disk/by-id/wwn-0x5002538e%08x' % (i * 4 + n),
+        path='/dev/disk/by-dname/sd%s' % chr(ord('a') + n),
+        partitions=[],
+        filesystem=None,
+        type='physical',
+    )
+
+
+def machine(i, kind='machine', seed=0):
+    rnd = random.Random(seed * 1000003 + i)
+    status, status_name = STATUS[rnd.randrange(len(STATUS))] if kind == 'machine' else (6, 'Deployed')
+    sid = system_id(kind, i)
+    interfaces = [interface(rnd, i, n) for n in range(rnd.randint(1, 4))]
+    virtual = kind == 'machine' and i % 10 == 0
+    return dict(
+        system_id=sid,
+        hostname='%s-%d' % (kind, i),
+        fqdn='%s-%d.maas' % (kind, i),
+        description='',
+        domain=dict(id=0, name='maas', authoritative=True, ttl=None, resource_record_count=0),
+        zone=dict(id=i % len(ZONES), name=ZONES[i % len(ZONES)], description=''),
+        pool=dict(id=i % len(POOLS), name=POOLS[i % len(POOLS)], description=''),
+        node_type=dict(machine=0, region=3, rack=2)[kind],
+        node_type_name=dict(machine='Machine', region='Region controller', rack='Rack controller')[kind],
+        status=status,
+        status_name=status_name,
+        status_message='',
+        status_action='',
+        architecture='amd64/generic',
+        osystem='ubuntu' if status == 6 else '',
+        distro_series='focal' if status == 6 else '',
+        hwe_kernel='ga-20.04',
+        min_hwe_kernel='',
+        cpu_count=rnd.choice([16, 32, 64]),
+        cpu_speed=2400,
+        memory=rnd.choice([65536, 131072, 262144]),
+        storage=960197.124096,
+        power_state='on' if status == 6 else 'off',
+        power_type='lxd' if virtual else 'ipmi',
+        owner='admin' if status in (6, 9, 10, 11) else None,
+        owner_data={},
+        locked=False,
+        netboot=status != 6,
+        tag_names=sorted(set(rnd.sample(TAGS[1:], 2) + (['virtual'] if virtual else []))),
+        ip_addresses=['10.0.%d.%d' % (i >> 8 & 0xff, i & 0xff)] if status == 6 else [],
+        boot_interface=interfaces[0],
+        interface_set=interfaces,
+        physicalblockdevice_set=[block_device(rnd, i, n) for n in range(rnd.randint(1, 3))],
+        blockdevice_set=[],
+        volume_groups=[],
+        raids=[],
+        cache_sets=[],
+        special_filesystems=[],
+        pod=dict(id=1, name='vmhost-1', resource_uri='/MAAS/api/2.0/pods/1/') if virtual else None,
+        hardware_info=dict(system_vendor='Supermicro', system_product='SYS-1029P', system_serial='S%08d' % i,
+                           mainboard_vendor='Supermicro', mainboard_product='X11DPU', cpu_model='Intel Xeon Gold 6226R'),
+        testing_status=2,
+        testing_status_name='Passed',
+        commissioning_status=2,
+        commissioning_status_name='Passed',
+        resource_uri='/MAAS/api/2.0/%s/%s/' % (dict(machine='machines', region='regioncontrollers', rack='rackcontrollers')[kind], sid),
+    )
+
+
+def matches(item, query):
+    ''' Whether a machine matches the filters of a listing query, like the MAAS API applies them. '''
+    values = dict(
+        id=[item['system_id']],
+        zone=[item['zone']['name']],
+        pool=[item['pool']['name']],
+        domain=[item['domain']['name']],
+        owner=[item['owner']],
+        pod=[item['pod']['name']] if item.get('pod') else [],
+        status=[item['status_name'].lower().replace(' ', '_')],
+    )
+    for name, wanted in query.items():
+        if name == 'tags':
+            # machines need all of the tags, the other filters match any of their values
+            if not set(wanted) <= set(item['tag_names']):
+                return False
+        elif name in values and not set(wanted) & set(values[name]):
+            return False
+    return True
+
+
+def power_parameters(item):
+    ''' Returns the op=power_parameters payload of a machine. '''
+    return dict(power_address='bmc-%s.maas' % item['hostname'], power_user='admin', power_pass='secret',
+                power_driver='LAN_2_0', mac_address='', cipher_suite_id='3')
+
+
+def fleet(machines, regions=1, racks=2, seed=0):
+    ''' Returns the payloads of the machines/, regioncontrollers/ and rackcontrollers/ endpoints. '''
+    return {
+        'machines/': [machine(i, 'machine', seed) for i in range(machines)],
+        'regioncontrollers/': [machine(i, 'region', seed) for i in range(regions)],
+        'rackcontrollers/': [machine(i, 'rack', seed) for i in range(racks)],
+        'pods/': [dict(id=1, name='vmhost-1', type='lxd', zone=dict(name='default'), pool=dict(name='default'),
+                       resource_uri='/MAAS/api/2.0/pods/1/')],
+    }
+
+
+class StandInMAAS(ThreadingMixIn, HTTPServer):
+    ''' Serves fixture payloads below /MAAS/api/2.0/. '''
+    daemon_threads = True
+    # concurrent clients would otherwise run into connection retries
+    request_queue_size = 128
+
+    def __init__(self, payloads, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.payloads = payloads
+        self.requests = []
+        self.events = []
+        # seconds every response is delayed by, to simulate the latency of a real region
+        self.delay = 0
+        # send ETags and answer matching If-None-Match headers with 304, which MAAS itself doesn't
+        self.etags = False
+        # endpoints answered with an error status instead, e.g. {'events/': 500}
+        self.failures = {}
+        self.encode()
+
+    def encode(self):
+        ''' Re-encodes the payloads, call it after modifying them. '''
+        self.encoded = dict((endpoint, json.dumps(data).encode('utf-8')) for endpoint, data in self.payloads.items())
+
+    def add_event(self, system_id, description, event_type='Node changed status', level='INFO'):
+        event = dict(id=len(self.events) + 1, node=system_id, hostname=system_id, username='admin', level=level,
+                     created='Thu, 01 Jan. 2021 00:00:00', type=event_type, description=description)
+        self.events.append(event)
+        return event
+
+    @property
+    def url(self):
+        return 'http://%s:%d/MAAS/' % self.server_address[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        if self.server.etags and self.command == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(status)
+            self.send_header('ETag', etag)
+        else:
+            self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        endpoint = url.path.split('/api/2.0/', 1)[-1]
+        self.server.requests.append((self.command, self.path))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if endpoint in self.server.failures:
+            return self.reply(self.server.failures[endpoint], b'"Internal Server Error"')
+
+        if endpoint in self.server.encoded:
+            if endpoint == 'machines/' and query:
+                items = [m for m in self.server.payloads[endpoint] if matches(m, query)]
+                return self.reply(200, json.dumps(items).encode('utf-8'))
+            if 'id' in query:
+                ids = set(query['id'])
+                return self.reply(200, json.dumps([m for m in self.server.payloads[endpoint] if m['system_id'] in ids]).encode('utf-8'))
+            return self.reply(200, self.server.encoded[endpoint])
+
+        if endpoint == 'users/' and query.get('op') == ['whoami']:
+            return self.reply(200, json.dumps(dict(username='admin', email='admin@example.com', is_superuser=True,
+                                                   resource_uri='/MAAS/api/2.0/users/admin/')).encode('utf-8'))
+
+        if endpoint == 'events/' and query.get('op') == ['query']:
+            after = int(query.get('after', ['0'])[0])
+            limit = int(query.get('limit', ['100'])[0])
+            events = [e for e in self.server.events if e['id'] > after and ('id' not in query or e['node'] in query['id'])]
+            events = list(reversed(events))[:limit]
+            return self.reply(200, json.dumps(dict(count=len(events), events=events, next_uri='', prev_uri='')).encode('utf-8'))
+
+        parts = endpoint.strip('/').split('/')
+        if len(parts) == 2 and parts[0] + '/' in self.server.payloads:
+            for item in self.server.payloads[parts[0] + '/']:
+                if item['system_id'] == parts[1]:
+                    if query.get('op') == ['power_parameters']:
+                        return self.reply(200, json.dumps(power_parameters(item)).encode('utf-8'))
+                    return self.reply(200, json.dumps(item).encode('utf-8'))
+
+        # per node listings, e.g. nodes/<system_id>/interfaces/
+        if len(parts) == 3 and parts[0] == 'nodes' and parts[2] in NODE_LISTINGS:
+            for items in self.server.payloads.values():
+                for item in items:
+                    if item['system_id'] == parts[1]:
+                        return self.reply(200, json.dumps(item[NODE_LISTINGS[parts[2]]]).encode('utf-8'))
+        self.reply(404, b'"Not Found"')
+
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        endpoint = url.path.split('/api/2.0/', 1)[-1]
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.requests.append((self.command, self.path))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        # machines/<system_id>/?op=deploy starts a deployment
+        parts = endpoint.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'machines' and query.get('op') == ['deploy']:
+            for item in self.server.payloads['machines/']:
+                if item['system_id'] == parts[1]:
+                    item.update(status=9, status_name='Deploying')
+                    self.server.encode()
+                    return self.reply(200, json.dumps(item).encode('utf-8'))
+        self.reply(404, b'"Not Found"')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic MAAS fleet')
+    parser.add_argument('--machines', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=5240)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = StandInMAAS(fleet(args.machines, seed=args.seed), ('127.0.0.1', args.port))
+    print('Serving %d machines on %s' % (args.machines, server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
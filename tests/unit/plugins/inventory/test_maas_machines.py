@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Felix Heilmeyer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import sys
+
+import pytest
+from six.moves import urllib
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins import loader
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'scripts'))
+from maas_fixtures import StandInMAAS, fleet  # noqa: E402
+
+
+if hasattr(loader, 'init_plugin_loader'):
+    loader.init_plugin_loader()
+# the plugin is loaded like ansible does, so its options are defined
+InventoryModule = type(loader.inventory_loader.get('heilerich.maas.maas_machines'))
+maas_machines = sys.modules[InventoryModule.__module__]
+
+
+@pytest.fixture
+def server():
+    server = StandInMAAS(fleet(6)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class Clock():
+    ''' Replaces the time of the inventory plugin, to age cache entries without waiting. '''
+    def __init__(self, monkeypatch):
+        self.offset = 0
+        real_time = maas_machines.time
+        monkeypatch.setattr(maas_machines, 'time', lambda: real_time() + self.offset)
+
+
+def parse(tmp_path, flush=False, **options):
+    # runs the inventory plugin with options and returns the inventory, flush is --flush-cache
+    path = str(tmp_path / 'test_maas.yml')
+    with open(path, 'w') as f:
+        json.dump(dict(plugin='heilerich.maas.maas_machines', **options), f)
+    inventory = InventoryData()
+    loader.inventory_loader.get('heilerich.maas.maas_machines').parse(inventory, DataLoader(), path, cache=not flush)
+    return inventory
+
+
+def endpoints(server):
+    # the endpoints and system id queries of the GET requests since the last call
+    requests = []
+    for method, path in server.requests:
+        url = urllib.parse.urlparse(path)
+        query = urllib.parse.parse_qs(url.query)
+        requests.append((url.path.split('/api/2.0/', 1)[-1], tuple(sorted(query.get('id', [])))))
+    del server.requests[:]
+    return requests
+
+
+@pytest.mark.parametrize('expression, names', [
+    ("hostname | regex_replace('machine', 'm')", set(['hostname'])),
+    ("ip_addresses | ansible.utils.ipaddr('10.0.0.0/8')", set(['ip_addresses'])),
+    ("status_name is ansible.builtin.truthy", set(['status_name'])),
+    ("maas_machine['zone'] ~ pool.name", set(['maas_machine', 'pool'])),
+    (None, set()),
+    ("hostname |", None),
+])
+def test_referenced_names(expression, names):
+    assert InventoryModule._referenced_names(expression) == names
+
+
+def test_referenced_names_of_templates():
+    assert InventoryModule._referenced_names('{{ zone }}_parent', template=True) == set(['zone'])
+    assert InventoryModule._referenced_names('parent', template=True) == set()
+
+
+def delta_options(server, tmp_path, **options):
+    return dict(dict(maas_url=server.url, api_key='a:b:c', machine_vars='inline', cache=True, cache_plugin='jsonfile',
+                     cache_connection=str(tmp_path / 'cache'), cache_timeout=60, cache_delta_refresh=True), **options)
+
+
+def machine(server, index):
+    return server.payloads['machines/'][index]
+
+
+def host_ips(inventory, server, index):
+    host = inventory.get_host(machine(server, index)['fqdn'])
+    return host.vars['maas_machine']['ip_addresses'] if host else None
+
+
+def test_delta_refresh_of_expired_entry(server, tmp_path, monkeypatch):
+    clock = Clock(monkeypatch)
+    options = delta_options(server, tmp_path)
+    hosts = len(parse(tmp_path, **options).hosts)
+    assert ('machines/', ()) in endpoints(server)
+
+    changed, deleted, unchanged = machine(server, 1), machine(server, 2), machine(server, 3)
+    changed['ip_addresses'] = ['10.9.9.9']
+    unchanged['ip_addresses'] = ['10.8.8.8']
+    server.payloads['machines/'].remove(deleted)
+    server.encode()
+    server.add_event(changed['system_id'], 'Changed the IP address')
+    server.add_event(deleted['system_id'], 'Deleted the machine')
+
+    # the entry is older than cache_timeout, only the machines with events are fetched
+    clock.offset = 120
+    inventory = parse(tmp_path, **options)
+    requests = endpoints(server)
+    assert ('machines/', ()) not in requests
+    assert ('machines/', tuple(sorted([changed['system_id'], deleted['system_id']]))) in requests
+    assert inventory.get_host(changed['fqdn']).vars['maas_machine']['ip_addresses'] == ['10.9.9.9']
+    assert inventory.get_host(deleted['fqdn']) is None
+    # changes without an event are not picked up
+    assert inventory.get_host(unchanged['fqdn']).vars['maas_machine']['ip_addresses'] != ['10.8.8.8']
+    assert len(inventory.hosts) == hosts - 1
+
+
+def test_delta_refresh_limit(server, tmp_path, monkeypatch):
+    clock = Clock(monkeypatch)
+    options = delta_options(server, tmp_path, cache_delta_refresh_limit=1)
+    parse(tmp_path, **options)
+    endpoints(server)
+    silent = machine(server, 1)
+    silent['ip_addresses'] = ['10.9.9.9']
+    server.encode()
+
+    clock.offset = 120
+    inventory = parse(tmp_path, **options)
+    assert ('machines/', ()) not in endpoints(server)
+    assert inventory.get_host(silent['fqdn']).vars['maas_machine']['ip_addresses'] != ['10.9.9.9']
+
+    # the limit of delta refreshes is reached, the next refresh fetches all machines
+    clock.offset = 240
+    inventory = parse(tmp_path, **options)
+    assert ('machines/', ()) in endpoints(server)
+    assert inventory.get_host(silent['fqdn']).vars['maas_machine']['ip_addresses'] == ['10.9.9.9']
+
+
+@pytest.mark.parametrize('flush, changes', [(True, {}), (False, dict(fields=['hostname', 'fqdn', 'ip_addresses']))])
+def test_full_fetch_on_flush_and_changed_options(server, tmp_path, monkeypatch, flush, changes):
+    options = delta_options(server, tmp_path)
+    parse(tmp_path, **options)
+    endpoints(server)
+    machine(server, 1)['ip_addresses'] = ['10.9.9.9']
+    server.encode()
+
+    inventory = parse(tmp_path, flush, **dict(options, **changes))
+    assert ('machines/', ()) in endpoints(server)
+    assert inventory.get_host(machine(server, 1)['fqdn']).vars['maas_machine']['ip_addresses'] == ['10.9.9.9']
+
+
+@pytest.mark.parametrize('change', [dict(version=1), dict(payload='bm90IHpsaWI=')])
+def test_unusable_cache_entry_is_fetched_again(server, tmp_path, change):
+    options = delta_options(server, tmp_path)
+    hosts = len(parse(tmp_path, **options).hosts)
+    endpoints(server)
+    parse(tmp_path, **options)
+    assert endpoints(server) == []
+
+    # an entry of another cache format version or with a corrupt payload is ignored
+    cache_dir = tmp_path / 'cache'
+    for name in os.listdir(str(cache_dir)):
+        if name.startswith('.'):
+            continue
+        with open(str(cache_dir / name)) as f:
+            data = json.load(f)
+        # newer ansible versions wrap the serialized value of jsonfile entries
+        entry = json.loads(data['__payload__']) if '__payload__' in data else data
+        entry.update(change)
+        if '__payload__' in data:
+            data['__payload__'] = json.dumps(entry)
+        with open(str(cache_dir / name), 'w') as f:
+            json.dump(data if '__payload__' in data else entry, f)
+
+    inventory = parse(tmp_path, **options)
+    assert ('machines/', ()) in endpoints(server)
+    assert len(inventory.hosts) == hosts
+
+
+MACHINE = dict(
+    hostname='node-1', status_name='Deployed', tag_names=['gpu'],
+    boot_interface=dict(mac_address='52:54:00:00:00:01', links=[dict(id=1, mode='auto', subnet=dict(cidr='10.0.0.0/24'))]),
+    interface_set=[dict(name='eth0', mac_address='52:54:00:00:00:01', links=[dict(id=1, subnet=dict(cidr='10.0.0.0/24'))]),
+                   dict(name='eth1', mac_address='52:54:00:00:00:02', links=[])],
+    pod=None,
+)
+
+
+@pytest.mark.parametrize('fields, exclude_fields, expected', [
+    ([], [], MACHINE),
+    (['hostname', 'missing'], [], dict(hostname='node-1')),
+    (['boot_interface.mac_address', 'boot_interface.links.subnet.cidr'], [],
+     dict(boot_interface=dict(mac_address='52:54:00:00:00:01', links=[dict(subnet=dict(cidr='10.0.0.0/24'))]))),
+    # a leaf above a nested path selects the whole value, in either order
+    (['boot_interface.links.id', 'boot_interface'], [], dict(boot_interface=MACHINE['boot_interface'])),
+    (['boot_interface', 'boot_interface.links.id'], [], dict(boot_interface=MACHINE['boot_interface'])),
+    # lists of dicts are traversed, scalars and None are kept as they are
+    (['interface_set.name', 'tag_names.name', 'pod.name'], [],
+     dict(interface_set=[dict(name='eth0'), dict(name='eth1')], tag_names=['gpu'], pod=None)),
+    (['interface_set.links.subnet.cidr'], [],
+     dict(interface_set=[dict(links=[dict(subnet=dict(cidr='10.0.0.0/24'))]), dict(links=[])])),
+    ([], ['interface_set', 'boot_interface.links', 'pod', 'tag_names', 'status_name'],
+     dict(hostname='node-1', boot_interface=dict(mac_address='52:54:00:00:00:01'))),
+    # an exclude overrides an include of the same or an enclosing path
+    (['hostname', 'interface_set'], ['interface_set.mac_address', 'interface_set.links'],
+     dict(hostname='node-1', interface_set=[dict(name='eth0'), dict(name='eth1')])),
+    (['hostname', 'tag_names'], ['tag_names'], dict(hostname='node-1')),
+])
+def test_field_projection(fields, exclude_fields, expected):
+    projection = maas_machines.FieldProjection(fields, exclude_fields, measure=True)
+    before = json.dumps(MACHINE, sort_keys=True)
+
+    assert projection.apply(MACHINE) == expected
+    # the machine data may be shared with a response kept for conditional_get
+    assert json.dumps(MACHINE, sort_keys=True) == before
+    assert bool(projection) == bool(fields or exclude_fields)
+    if projection:
+        assert projection.bytes_out == len(json.dumps(expected))
+        assert projection.bytes_in == len(json.dumps(MACHINE))
+
+
+@pytest.mark.parametrize('options, kept', [
+    (dict(), True),
+    (dict(fields=['hostname', 'fqdn']), False),
+    (dict(exclude_fields=['interface_set']), False),
+])
+def test_projected_listings_are_not_kept_for_conditional_get(server, tmp_path, options, kept):
+    inventory = parse(tmp_path, maas_url=server.url, api_key='a:b:c', conditional_get=True, **options)
+    assert len(inventory.hosts) == len(server.payloads['machines/'])
+
+    api = sys.modules[maas_machines.get_session.__module__]
+    session = [s for (url, key, version), s in api._sessions.items() if url == server.url][0]
+    listings = [key for key in session.conditional.entries if urllib.parse.urlparse(key).path.endswith('/machines/')]
+    assert bool(listings) == kept
+
+
+@pytest.mark.parametrize('include_vms', [True, False])
+def test_enrich_only_inventory_machines(server, tmp_path, include_vms):
+    inventory = parse(tmp_path, maas_url=server.url, api_key='a:b:c', machine_vars='inline', include_vms=include_vms,
+                      include_controllers=True, enrich=[dict(name='interfaces', endpoint='nodes/{system_id}/interfaces/')])
+
+    machines = [m for m in server.payloads['machines/'] if include_vms or m['pod'] is None]
+    assert 0 < len(machines) <= len(server.payloads['machines/'])
+    enriched = sorted(endpoint.split('/')[1] for endpoint, ids in endpoints(server) if endpoint.startswith('nodes/'))
+    # controllers and the VMs left out of the inventory are not enriched
+    assert enriched == sorted(m['system_id'] for m in machines)
+    for m in machines:
+        assert inventory.get_host(m['fqdn']).vars['maas_machine']['interfaces'] == m['interface_set']
+
+
+@pytest.mark.parametrize('filters, expected', [
+    (dict(zone=['rack-a', 'rack-b']), [1, 2, 5]),
+    (dict(pool=['compute']), [1, 4]),
+    (dict(zone=['default'], pool=['default']), [0]),
+    (dict(zone=['rack-c'], pool=['default']), [3]),
+    (dict(zone=['rack-c'], pool=['storage']), []),
+])
+def test_filters(server, tmp_path, filters, expected):
+    inventory = parse(tmp_path, maas_url=server.url, api_key='a:b:c', **filters)
+
+    assert sorted(inventory.hosts) == sorted(machine(server, i)['fqdn'] for i in expected)
+    listings = [urllib.parse.urlparse(path) for method, path in server.requests if '/machines/' in path]
+    assert [urllib.parse.parse_qs(url.query) for url in listings] == [filters]
+
+
+def test_tag_filter_needs_all_tags(server, tmp_path):
+    tags = machine(server, 1)['tag_names'][:2]
+    expected = [m['fqdn'] for m in server.payloads['machines/'] if set(tags) <= set(m['tag_names'])]
+    inventory = parse(tmp_path, maas_url=server.url, api_key='a:b:c', tags=tags)
+
+    assert machine(server, 1)['fqdn'] in expected
+    assert sorted(inventory.hosts) == sorted(expected)
+    assert len(expected) < len(server.payloads['machines/'])
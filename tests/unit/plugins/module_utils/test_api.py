@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Felix Heilmeyer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import json
+import os
+import sys
+import time
+
+import pytest
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+
+from ansible_collections.heilerich.maas.plugins.module_utils.api import APISession, JitterRetry, ResponseCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'scripts'))
+from maas_fixtures import StandInMAAS, fleet  # noqa: E402
+
+
+class ChunkedResponse():
+    ''' A response whose body is returned in chunks of chunk_size bytes, whatever iter_decode asks for. '''
+    def __init__(self, body, chunk_size, encoding='utf-8'):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i:i + self.chunk_size]
+
+
+@pytest.fixture(scope='module')
+def session():
+    return APISession('http://127.0.0.1:5240/MAAS/', 'a:b:c')
+
+
+def decode(session, body, chunk_size):
+    return list(session.iter_decode(ChunkedResponse(body, chunk_size)))
+
+
+MACHINES = [
+    dict(system_id='abc123', hostname='node-1', status=6, cpu_speed=2400, memory=16384.5,
+         tag_names=['virtual', 'gpu'], owner=None, locked=False, power_state='on',
+         boot_interface=dict(mac_address='52:54:00:00:00:01', links=[dict(id=1, mode='auto')])),
+    dict(system_id='def456', hostname='node-2', description='say "hello"\n\ttab \\ backslash', status=-1,
+         cpu_speed=1e3, memory=-2.5e-3, tag_names=[], owner='admin', locked=True, power_state=None),
+]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 20])
+def test_iter_decode_chunk_sizes(session, chunk_size):
+    body = json.dumps(MACHINES, indent=1).encode('utf-8')
+    assert decode(session, body, chunk_size) == MACHINES
+
+
+@pytest.mark.parametrize('body', [b'[]', b' [ ] ', b'\n[\n]\n'])
+def test_iter_decode_empty(session, body):
+    assert decode(session, body, 1) == []
+
+
+def test_iter_decode_numbers_split_across_chunks(session):
+    numbers = [0, 7, 12345, -987654321, 3.25, -0.5, 6.5e10, 1E-7, 123456789012345678901234567890]
+    body = json.dumps(numbers).replace(' ', '').encode('utf-8')
+    # every possible split point of every number
+    for chunk_size in range(1, len(body) + 1):
+        assert decode(session, body, chunk_size) == numbers
+
+
+def test_iter_decode_multibyte_utf8(session):
+    items = [u'äöü', u'€ 1', dict(name=u'ß', emoji=u'😀'), u'日本語']
+    body = json.dumps(items, ensure_ascii=False).encode('utf-8')
+    # 1, 2 and 3 byte chunks split the 2, 3 and 4 byte characters
+    for chunk_size in (1, 2, 3, 5):
+        assert decode(session, body, chunk_size) == items
+
+
+def test_iter_decode_other_encoding(session):
+    items = [u'äöü', dict(name=u'ß')]
+    body = json.dumps(items, ensure_ascii=False).encode('latin-1')
+    assert list(session.iter_decode(ChunkedResponse(body, 1, 'latin-1'))) == items
+
+
+@pytest.mark.parametrize('body', [b'[1, 2] x', b'[1, 2]]', b'[1, 2][3]', b'[{"a": 1}] ,'])
+def test_iter_decode_trailing_garbage(session, body):
+    items = session.iter_decode(ChunkedResponse(body, 1))
+    with pytest.raises(ValueError):
+        list(items)
+
+
+@pytest.mark.parametrize('body', [b'[', b'[1, 2', b'[1, 2,', b'[{"a": 1}', b'[{"a": 1', b'["abc', b'[12'])
+def test_iter_decode_truncated(session, body):
+    for chunk_size in (1, len(body)):
+        with pytest.raises(ValueError):
+            decode(session, body, chunk_size)
+
+
+@pytest.mark.parametrize('body', [b'{"a": 1}', b'"abc"', b'1', b'[1 2]', b'[1,,2]', b'[,1]', b''])
+def test_iter_decode_invalid(session, body):
+    with pytest.raises(ValueError):
+        decode(session, body, 1)
+
+
+def test_iter_decode_yields_items_before_an_error(session):
+    items = session.iter_decode(ChunkedResponse(b'[{"a": 1}, {"b": 2}, {"c"', 4))
+    assert next(items) == dict(a=1)
+    assert next(items) == dict(b=2)
+    with pytest.raises(ValueError):
+        next(items)
+
+
+@pytest.fixture
+def server():
+    server = StandInMAAS(fleet(2)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_errors_fail_fast_by_default(server):
+    server.failures['machines/'] = 503
+    session = APISession(server.url, 'a:b:c')
+
+    started = time.time()
+    response = session.call('GET', 'machines/', cached=False)
+
+    assert response.status_code == 503
+    assert len(server.requests) == 1
+    assert time.time() - started < 2
+
+
+def test_retry_status_is_retried(server):
+    server.failures['machines/'] = 503
+    session = APISession(server.url, 'a:b:c', retries=2, retry_backoff=0, retry_jitter=0, retry_status=[503])
+
+    assert session.call('GET', 'machines/', cached=False).status_code == 503
+    assert len(server.requests) == 3
+
+
+def test_first_retry_is_immediate():
+    retry = JitterRetry(total=5, backoff_factor=2, jitter=1)
+    retry = retry.increment('GET', '/', error=ConnectTimeoutError())
+    assert retry.get_backoff_time() == 0
+    for attempt in range(2, 5):
+        retry = retry.increment('GET', '/', error=ConnectTimeoutError())
+        assert 2 * 2 ** (attempt - 1) <= retry.get_backoff_time() <= 2 * 2 ** (attempt - 1) + 1
+
+
+class StoredResponse():
+    ok = True
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+
+@pytest.mark.parametrize('changed, invalidated', [
+    ('machines/abc/', ['machines/', 'machines/abc/', 'machines/abc/blockdevices/']),
+    ('machines/abc', ['machines/', 'machines/abc/', 'machines/abc/blockdevices/']),
+    ('machines/', ['machines/', 'machines/abc/', 'machines/abcd/', 'machines/abc/blockdevices/']),
+    ('machines/abc/blockdevices/', ['machines/', 'machines/abc/', 'machines/abc/blockdevices/']),
+    ('machine/', []),
+    ('tags/', ['tags/']),
+])
+def test_cache_invalidation_matches_whole_path_segments(tmp_path, changed, invalidated):
+    base = 'http://127.0.0.1:5240/MAAS/api/2.0/'
+    cache = ResponseCache(str(tmp_path), 60)
+    paths = ['machines/', 'machines/abc/', 'machines/abcd/', 'machines/abc/blockdevices/', 'machinesets/', 'tags/']
+    for path in paths:
+        for query in ('', '?id=abc', '?op=power_parameters'):
+            cache.put('GET ' + base + path + query, path, base, StoredResponse(path))
+    # entries of another region are never invalidated
+    cache.put('GET other/machines/', 'machines/', 'other/', StoredResponse('other'))
+
+    cache.invalidate(base, changed)
+
+    for path in paths:
+        for query in ('', '?id=abc', '?op=power_parameters'):
+            assert (cache.get('GET ' + base + path + query, path, base) is None) == (path in invalidated), path + query
+    assert cache.get('GET other/machines/', 'machines/', 'other/').data == 'other'
+    assert cache.stats['invalidations'] == 3 * len(invalidated)
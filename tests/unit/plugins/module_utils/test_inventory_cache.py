@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Felix Heilmeyer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import base64
+import json
+import zlib
+
+import pytest
+
+from ansible_collections.heilerich.maas.plugins.module_utils.inventory_cache import (
+    CACHE_VERSION, CacheFormatError, decode_hosts, encode_hosts)
+
+FIELDS = ('hostname', 'zone', 'status', 'tags', 'metal')
+SHARED_FIELDS = ('zone', 'status', 'metal')
+
+HOSTS = [
+    dict(hostname='node-1', zone='default', status='deployed', tags=['gpu', 'virtual'], metal=True),
+    dict(hostname='node-2', zone='default', status=None, tags=[], metal=False),
+    dict(hostname='node-3', zone='rack-2', status='deployed', tags=None, metal=True),
+]
+
+
+def payload(entry):
+    return json.loads(zlib.decompress(base64.b64decode(entry['payload'])).decode('utf-8'))
+
+
+def repack(entry, payload):
+    entry = dict(entry)
+    entry['payload'] = base64.b64encode(zlib.compress(json.dumps(payload).encode('utf-8'))).decode('ascii')
+    return entry
+
+
+def test_round_trip():
+    entry = encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas', fingerprint='abc', cursors=dict(maas=7))
+
+    assert entry['version'] == CACHE_VERSION
+    assert entry['count'] == 3
+    assert entry['fingerprint'] == 'abc'
+    assert entry['cursors'] == dict(maas=7)
+    assert decode_hosts(json.loads(json.dumps(entry))) == HOSTS
+
+
+def test_shared_columns_store_values_once():
+    columns = payload(encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas'))['columns']
+
+    assert columns['zone'] == dict(table=['default', 'rack-2'], index=[0, 0, 1])
+    assert columns['status'] == dict(table=['deployed', None], index=[0, 1, 0])
+    assert columns['hostname'] == dict(values=['node-1', 'node-2', 'node-3'])
+
+
+def test_empty_round_trip():
+    entry = encode_hosts([], FIELDS, SHARED_FIELDS, 'https://maas')
+    assert entry['count'] == 0
+    assert decode_hosts(entry) == []
+
+
+def test_sparse_rows_are_stored_as_none():
+    hosts = [dict(hostname='node-1', zone='default'), dict(hostname='node-2', status='deployed')]
+
+    rows = decode_hosts(encode_hosts(hosts, FIELDS, SHARED_FIELDS, 'https://maas'))
+
+    assert rows == [dict(hostname='node-1', zone='default', status=None, tags=None, metal=None),
+                    dict(hostname='node-2', zone=None, status='deployed', tags=None, metal=None)]
+
+
+def test_missing_column_is_left_out():
+    entry = encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas')
+    data = payload(entry)
+    del data['columns']['tags']
+    del data['columns']['zone']
+
+    rows = decode_hosts(repack(entry, data))
+
+    assert rows == [dict((k, v) for k, v in host.items() if k not in ('tags', 'zone')) for host in HOSTS]
+
+
+def test_non_ascii_round_trip():
+    hosts = [dict(hostname=u'knoten-ä', zone=u'Zone 日本', status=u'déployé', tags=[u'ß', u'😀'], metal=True),
+             dict(hostname=u'knoten-ö', zone=u'Zone 日本', status=None, tags=[], metal=False)]
+
+    entry = json.loads(json.dumps(encode_hosts(hosts, FIELDS, SHARED_FIELDS, u'https://maas/ü')))
+
+    assert entry['source'] == u'https://maas/ü'
+    assert decode_hosts(entry) == hosts
+
+
+@pytest.mark.parametrize('version', [None, 1, CACHE_VERSION + 1, str(CACHE_VERSION)])
+def test_version_mismatch(version):
+    entry = encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas')
+    entry['version'] = version
+    with pytest.raises(CacheFormatError, match='Unsupported'):
+        decode_hosts(entry)
+
+
+@pytest.mark.parametrize('entry', [None, [], 'abc', [dict(hostname='node-1')]])
+def test_not_an_entry(entry):
+    with pytest.raises(CacheFormatError, match='Unsupported'):
+        decode_hosts(entry)
+
+
+def test_corrupt_base64():
+    entry = encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas')
+    entry['payload'] = entry['payload'][:-6] + '!@#$%^'
+    with pytest.raises(CacheFormatError, match='Corrupt'):
+        decode_hosts(entry)
+
+
+def test_corrupt_zlib():
+    entry = encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas')
+    data = bytearray(base64.b64decode(entry['payload']))
+    entry['payload'] = base64.b64encode(bytes(data[:len(data) // 2])).decode('ascii')
+    with pytest.raises(CacheFormatError, match='Corrupt'):
+        decode_hosts(entry)
+
+    entry['payload'] = base64.b64encode(b'not zlib data').decode('ascii')
+    with pytest.raises(CacheFormatError, match='Corrupt'):
+        decode_hosts(entry)
+
+
+@pytest.mark.parametrize('change', [
+    lambda data: data.pop('count'),
+    lambda data: data['columns']['hostname']['values'].pop(),
+    lambda data: data['columns']['zone']['index'].append(5),
+    lambda data: data['columns']['zone']['index'].__setitem__(0, 9),
+])
+def test_inconsistent_payload(change):
+    entry = encode_hosts(HOSTS, FIELDS, SHARED_FIELDS, 'https://maas')
+    data = payload(entry)
+    change(data)
+    with pytest.raises(CacheFormatError, match='Corrupt'):
+        decode_hosts(repack(entry, data))
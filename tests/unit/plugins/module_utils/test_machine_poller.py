@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Felix Heilmeyer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+from six.moves import urllib
+
+from ansible_collections.heilerich.maas.plugins.module_utils.api import get_session
+from ansible_collections.heilerich.maas.plugins.module_utils.helpers import AttrDict, MachinePoller
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'scripts'))
+from maas_fixtures import StandInMAAS, fleet  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    server = StandInMAAS(fleet(4)).start()
+    for machine in server.payloads['machines/']:
+        machine.update(status=9, status_name='Deploying')
+    server.encode()
+    # events of other machines are in the log before the wait starts
+    server.add_event('other', 'unrelated machine')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def poller(server, **config):
+    config = AttrDict(dict(wait_interval=0.05, wait_timeout=10, wait_mode='events', wait_max_interval=30), **config)
+    return MachinePoller(config, get_session(server.url, 'a:b:c'))
+
+
+def deploy_later(server, system_id, delay, event=True):
+    # marks the machine deployed after delay seconds, with or without an event
+    def deploy():
+        time.sleep(delay)
+        for machine in server.payloads['machines/']:
+            if machine['system_id'] == system_id:
+                machine.update(status=6, status_name='Deployed')
+        server.encode()
+        if event:
+            server.add_event(system_id, "From 'Deploying' to 'Deployed'")
+    thread = threading.Thread(target=deploy)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def machine_requests(server):
+    # the system ids of the machine requests, one set per machines/ listing or machines/<id>/ request
+    requests = []
+    for method, path in list(server.requests):
+        url = urllib.parse.urlparse(path)
+        endpoint = url.path.split('/api/2.0/', 1)[-1]
+        if endpoint == 'machines/':
+            requests.append(set(urllib.parse.parse_qs(url.query).get('id', [])))
+        elif endpoint.startswith('machines/'):
+            requests.append(set([endpoint.split('/')[1]]))
+    return requests
+
+
+def test_event_wakes_poller(server):
+    system_id = server.payloads['machines/'][0]['system_id']
+    p = poller(server)
+    deploy_later(server, system_id, 0.3)
+
+    started = time.time()
+    error, data = p.wait(system_id, 'deployed', ['deploying'])
+
+    assert error is None
+    assert data['status_name'] == 'Deployed'
+    assert time.time() - started < 5
+    # the machine is requested once at the start and once after its event
+    assert machine_requests(server) == [set([system_id])] * 2
+    assert p.stats[system_id]['event_queries'] > 0
+
+
+def test_no_event_falls_back_after_max_interval(server):
+    system_id = server.payloads['machines/'][0]['system_id']
+    p = poller(server, wait_max_interval=1)
+    deploy_later(server, system_id, 0.2, event=False)
+
+    started = time.time()
+    error, data = p.wait(system_id, 'deployed', ['deploying'])
+
+    assert error is None
+    assert 1 <= time.time() - started < 5
+    assert machine_requests(server) == [set([system_id])] * 2
+
+
+def test_failed_events_query_lists_machines(server):
+    system_ids = [machine['system_id'] for machine in server.payloads['machines/']]
+    server.failures['events/'] = 500
+    p = poller(server)
+    for system_id in system_ids:
+        deploy_later(server, system_id, 0.3, event=False)
+
+    started = time.time()
+    results = p.wait_many([dict(system_id=system_id, target='deployed', acceptable_status=['deploying'])
+                           for system_id in system_ids])
+
+    assert all(error is None for error, data in results.values())
+    # every failed events query is followed by a listing, long before wait_max_interval
+    assert time.time() - started < 5
+    requests = machine_requests(server)
+    assert len(requests) > 2
+    assert all(ids == set(system_ids) for ids in requests)
+
+
+def test_cursors_advance_per_machine(server):
+    first, second = [machine['system_id'] for machine in server.payloads['machines/'][:2]]
+    p = poller(server)
+    deploy_later(server, first, 0.3)
+    deploy_later(server, second, 0.8)
+
+    results = p.wait_many([dict(system_id=system_id, target='deployed', acceptable_status=['deploying'])
+                           for system_id in (first, second)])
+
+    assert all(error is None for error, data in results.values())
+    # after the first listing only the machine with a new event is requested
+    assert machine_requests(server) == [set([first, second]), set([first]), set([second])]
+
+
+def test_events_advances_cursors(server):
+    first, second, third = [machine['system_id'] for machine in server.payloads['machines/'][:3]]
+    p = poller(server)
+    cursors = dict.fromkeys([first, second, third], p._event_cursor())
+
+    server.add_event(first, 'first event')
+    server.add_event(second, 'second event')
+    assert p._events(cursors, [first, second, third]) == [first, second]
+    assert p._events(cursors, [first, second, third]) == []
+
+    server.add_event(third, 'third event')
+    assert p._events(cursors, [first, second, third]) == [third]
+    assert p._events(cursors, [first, second]) == []
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2021 Felix Heilmeyer
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import (absolute_import, division, print_function)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import pytest
+
+from ansible_collections.heilerich.maas.plugins.module_utils import helpers
+from ansible_collections.heilerich.maas.plugins.module_utils.helpers import AttrDict, PollSchedule
+
+
+class Clock():
+    ''' Replaces the monotonic clock of the helpers, so a schedule can be followed without sleeping. '''
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(helpers, 'monotonic', lambda: self.now)
+
+
+class Random():
+    ''' Replaces the random module of the helpers, uniform returns the fraction value of its range. '''
+    def __init__(self, monkeypatch, value=0.5):
+        self.value = value
+        self.calls = []
+        monkeypatch.setattr(helpers, 'random', self)
+
+    def uniform(self, low, high):
+        self.calls.append((low, high))
+        return low + (high - low) * self.value
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    return Clock(monkeypatch)
+
+
+@pytest.fixture
+def rnd(monkeypatch):
+    return Random(monkeypatch)
+
+
+def schedule(expected=None, **config):
+    config = AttrDict(dict(wait_interval=2, wait_timeout=100, wait_backoff=1, wait_max_interval=0, wait_jitter=0),
+                      **config)
+    return PollSchedule(config, expected)
+
+
+def follow(clock, schedule, statuses, request_time=0.5):
+    # polls with the given statuses at the times the schedule asks for, returns the delays after each poll
+    delays = []
+    for status in statuses:
+        started = clock.now
+        clock.now += request_time
+        schedule.polled(started, status)
+        delay = schedule.delay()
+        delays.append(delay)
+        if delay is None:
+            break
+        clock.now += delay
+    return delays
+
+
+def test_baseline_fixed_interval(clock, rnd):
+    s = schedule()
+    follow(clock, s, ['deploying'] * 3 + ['failed', 'deploying'])
+    # the polls start wait_interval apart, whatever the requests take and the statuses are
+    assert [round(d, 6) for d in follow(clock, s, ['deploying'] * 5)] == [1.5] * 5
+    assert s.polls == 10
+    assert s.interval == 2
+
+
+def test_backoff_is_capped_at_max_interval(clock, rnd):
+    s = schedule(wait_backoff=2, wait_max_interval=10)
+    delays = follow(clock, s, ['deploying'] * 6, request_time=0)
+    assert delays == [2, 4, 8, 10, 10, 10]
+
+
+def test_status_change_resets_backoff(clock, rnd):
+    s = schedule(wait_backoff=2, wait_max_interval=10)
+    delays = follow(clock, s, ['commissioning'] * 3 + ['deploying', 'deploying'], request_time=0)
+    assert delays == [2, 4, 8, 2, 4]
+
+
+@pytest.mark.parametrize('config', [dict(wait_backoff=0.5), dict(wait_backoff=None), dict(wait_max_interval=1)])
+def test_backoff_and_max_interval_bounds(clock, rnd, config):
+    # a backoff below 1 doesn't shrink the interval, and the maximum is never below wait_interval
+    s = schedule(**config)
+    assert follow(clock, s, ['deploying'] * 3, request_time=0) == [2, 2, 2]
+
+
+@pytest.mark.parametrize('value', [0, 0.25, 0.5, 1])
+def test_jitter_bounds(clock, monkeypatch, value):
+    rnd = Random(monkeypatch, value)
+    s = schedule(wait_jitter=0.2, wait_interval=10)
+    delays = follow(clock, s, ['deploying'] * 3, request_time=0)
+    assert rnd.calls == [(-0.2, 0.2)] * 3
+    assert delays == [pytest.approx(10 * (0.8 + 0.4 * value))] * 3
+    assert all(8 <= d <= 12 for d in delays)
+
+
+def test_expected_duration_limits_first_delay(clock, rnd):
+    # the first poll at the start, the next one at the expected end of the wait rather than after the interval
+    s = schedule(expected=5, wait_interval=2, wait_backoff=4, wait_max_interval=60)
+    delays = follow(clock, s, ['deploying'] * 4, request_time=0)
+    assert delays == [2, 3, 2, 8]
+    assert clock.now - s.start == 15
+
+
+def test_expected_duration_never_below_interval(clock, rnd):
+    # a wait expected to end within the interval doesn't poll more often than wait_interval
+    s = schedule(expected=0.5, wait_interval=2)
+    assert follow(clock, s, ['deploying'] * 2, request_time=0) == [2, 2]
+
+
+def test_expected_duration_longer_than_interval(clock, rnd):
+    s = schedule(expected=30, wait_interval=10, wait_backoff=1)
+    assert follow(clock, s, ['deploying'] * 4, request_time=0) == [10, 10, 10, 10]
+
+
+def test_last_poll_at_deadline(clock, rnd):
+    s = schedule(wait_timeout=7, wait_interval=3)
+    delays = follow(clock, s, ['deploying'] * 5, request_time=0)
+    # polls at 0, 3, 6 and the deadline at 7, after which there is no next poll
+    assert delays == [3, 3, 1, None]
+    assert s.polls == 4
+
+
+def test_stats(clock, rnd):
+    s = schedule()
+    follow(clock, s, ['deploying'] * 3, request_time=0.5)
+    s.event_queries = 2
+    assert s.stats() == dict(polls=3, event_queries=2, elapsed=6.0, request_time=1.5, wasted_latency=2.0)